@@ -1,15 +1,15 @@
 import streamlit as st
-import graphviz
 import os
 import time
-import google.generativeai as genai
 import json
+import random
 import re
+import numpy as np
 import pandas as pd
-from google.api_core import exceptions as google_exceptions
 
 # モジュール群のインポート
-from data import TOPOLOGY
+import data as topology_data
+from data import TOPOLOGY, get_topology_index
 from logic import CausalInferenceEngine, Alarm, simulate_cascade_failure
 from network_ops import (
     run_diagnostic_simulation, 
@@ -25,9 +25,21 @@ from network_ops import (
     RemediationResult
 )
 from verifier import verify_log_content, format_verification_report
-from inference_engine import LogicalRCA
+from inference_engine import LogicalRCA, NO_ALERT_RESULT
 from rate_limiter import GlobalRateLimiter, RateLimitConfig
+import llm_cache
+from dataclasses import asdict
+import functools
 import hashlib
+import itertools
+import sys
+import types
+from typing import NamedTuple
+
+try:
+    import orjson  # 任意依存（未導入なら標準 json にフォールバック）
+except ImportError:
+    orjson = None
 
 # --- ページ設定 ---
 st.set_page_config(page_title="Antigravity Autonomous", page_icon="⚡", layout="wide")
@@ -46,34 +58,190 @@ def get_rate_limiter():
 
 rate_limiter = get_rate_limiter()
 
+# =====================================================
+# コックピット表示用の定数（行ごとの文字列生成を回避）
+# =====================================================
+STATUS_DANGER = sys.intern("🔴 危険 (根本原因)")
+STATUS_WARNING = sys.intern("🟡 警告 (被疑箇所)")
+STATUS_WATCH = sys.intern("⚪ 監視中")
+STATUS_UNREACHABLE = sys.intern("⚫ 応答なし (上位障害)")
+ACTION_AUTO_FIX = sys.intern("🚀 自動修復が可能")
+ACTION_INVESTIGATE = sys.intern("🔍 詳細調査を推奨")
+ACTION_WATCH = sys.intern("👁️ 静観")
+ACTION_WAIT_UPSTREAM = sys.intern("⛔ 対応不要 (上位復旧待ち)")
+# 修復ステップの表示順（検証ログもこの順で連結）
+REMEDIATION_STEPS = ("Backup", "Apply", "Verify")
+
+# チャット履歴タブで描画する最大メッセージ数（ウィジェット数を一定に保つ）
+CHAT_HISTORY_VISIBLE_TURNS = 50
+# ストリーミング表示の更新間隔（秒）。チャンク毎の再描画を間引く
+STREAM_FLUSH_INTERVAL = 0.032
+
+# 修復後ログの成功判定（"up"/"ok" の部分一致、大文字小文字無視）
+# ※ 語境界は付けない: デモの修復ログは "✅ Backup: ..." の "up" で成功判定される
+_SUCCESS_RE = re.compile(r"up|ok", re.IGNORECASE)
+
+# シナリオ一覧（カテゴリ -> シナリオ名）。rerun ごとに再構築しないよう読み取り専用の定数にする
+SCENARIO_MAP = types.MappingProxyType({
+    "基本・広域障害": ("正常稼働", "1. WAN全回線断", "2. FW片系障害", "3. L2SWサイレント障害"),
+    "WAN Router": ("4. [WAN] 電源障害：片系", "5. [WAN] 電源障害：両系", "6. [WAN] BGPルートフラッピング", "7. [WAN] FAN故障", "8. [WAN] メモリリーク"),
+    "Firewall (Juniper)": ("9. [FW] 電源障害：片系", "10. [FW] 電源障害：両系", "11. [FW] FAN故障", "12. [FW] メモリリーク"),
+    "L2 Switch": ("13. [L2SW] 電源障害：片系", "14. [L2SW] 電源障害：両系", "15. [L2SW] FAN故障", "16. [L2SW] メモリリーク"),
+    "複合・その他": ("17. [WAN] 複合障害：電源＆FAN", "18. [Complex] 同時多発：FW & AP", "99. [Live] Cisco実機診断"),
+})
+SCENARIO_CATEGORIES = tuple(SCENARIO_MAP)
+
+# シナリオ名のタグ判定（[WAN] 等のブラケットタグ、または基本シナリオ名）
+_SCENARIO_TAG_RE = re.compile(r"\[(WAN|FW|L2SW|Complex|Live)\]|WAN全回線断|FW片系障害")
+# 機器別シナリオのタグ -> find_target_node_id の検索条件 (node_type, layer)
+_SCENARIO_TARGET_QUERY = types.MappingProxyType({
+    "WAN": ("ROUTER", None),
+    "FW": ("FIREWALL", None),
+    "L2SW": ("SWITCH", 4),
+})
+
 # ==========================================
 # 関数定義
 # ==========================================
 def find_target_node_id(topology, node_type=None, layer=None, keyword=None):
-    """トポロジーから条件に合うノードIDを検索"""
-    for node_id, node in topology.items():
-        if node_type and node.type != node_type: continue
-        if layer and node.layer != layer: continue
-        if keyword:
-            hit = False
-            if keyword in node_id: hit = True
-            for v in node.metadata.values():
-                if isinstance(v, str) and keyword in v: hit = True
-            if not hit: continue
-        return node_id
+    """トポロジーから条件に合うノードIDを検索（索引で候補を絞り込み、トポロジー順で最初の一致を返す）"""
+    index = get_topology_index(topology)
+    if node_type and layer:
+        candidates = index.by_type_layer.get((node_type, layer), ())
+    elif node_type:
+        candidates = index.by_type.get(node_type, ())
+    elif layer:
+        candidates = index.by_layer.get(layer, ())
+    else:
+        candidates = index.node_ids
+    if not keyword:
+        return candidates[0] if candidates else None
+    # キーワードは大文字小文字を区別せず、node_id / 文字列メタデータに部分一致
+    needle = keyword.casefold()
+    search_blobs = index.search_blobs
+    for node_id in candidates:
+        if needle in search_blobs[node_id]:
+            return node_id
     return None
 
+
+@st.cache_resource
+def _get_target_finder():
+    """rerun を跨いで保持される find_target_node_id(TOPOLOGY, ...) のメモ化版（TOPOLOGY は実行中不変）"""
+    @functools.lru_cache(maxsize=128)
+    def _find(node_type, keyword, layer, topology_version):
+        return find_target_node_id(TOPOLOGY, node_type=node_type, layer=layer, keyword=keyword)
+    return _find
+
+
+def _find_target_cached(topology, node_type=None, layer=None, keyword=None):
+    """シナリオハンドラ用: 既定トポロジーならメモ化結果を返す（それ以外は都度検索）"""
+    if topology is TOPOLOGY:
+        return _get_target_finder()(node_type, keyword, layer, topology_data.TOPOLOGY_VERSION)
+    return find_target_node_id(topology, node_type=node_type, layer=layer, keyword=keyword)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _load_config_cached(path: str, mtime_ns: int) -> str:
+    """設定ファイル本文のキャッシュ（mtime が変われば別キーとして再読込）
+    app.py は rerun ごとに再実行されるため、lru_cache ではなく st.cache_data で保持する。
+    """
+    # バイナリで一括読込してデコード（テキストモードの改行変換を通さない）
+    with open(path, "rb") as f:
+        data = f.read()
+    if b"\r\n" in data:
+        data = data.replace(b"\r\n", b"\n")
+    return data.decode("utf-8", "replace")
+
+
+def _stat_config(path: str) -> int | None:
+    """設定ファイルの mtime_ns（存在しなければ None）"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _locate_config(device_id) -> tuple[str, int] | None:
+    """設定ファイルの (パス, mtime_ns)。見つからなければ None"""
+    # ★ configs/ 配下を優先し、無い場合のみフラット名を stat（ヒット時は syscall 1回）
+    path = f"configs/{device_id}.txt"
+    mtime_ns = _stat_config(path)
+    if mtime_ns is None:
+        path = f"{device_id}.txt"
+        mtime_ns = _stat_config(path)
+        if mtime_ns is None:
+            return None
+    return path, mtime_ns
+
+
 def load_config_by_id(device_id):
     """configsフォルダから設定ファイルを読み込む"""
-    possible_paths = [f"configs/{device_id}.txt", f"{device_id}.txt"]
-    for path in possible_paths:
-        if os.path.exists(path):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    return f.read()
-            except Exception:
-                pass
-    return "Config file not found."
+    located = _locate_config(device_id)
+    if located is None:
+        return "Config file not found."
+    path, mtime_ns = located
+    try:
+        return _load_config_cached(path, mtime_ns)
+    except Exception:
+        return "Config file not found."
+
+RETRY_BACKOFF_BASE = 1.0   # 秒
+RETRY_BACKOFF_CAP = 20.0   # 秒
+
+
+def _retry_after_seconds(exc) -> float | None:
+    """例外に付随する Retry-After ヘッダ（秒）を取得。無ければ None"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("Retry-After")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_delay(attempt: int, exc=None) -> float:
+    """フルジッター付き指数バックオフ（Retry-After があればそれを優先）"""
+    retry_after = _retry_after_seconds(exc)
+    if retry_after is not None:
+        return min(retry_after, RETRY_BACKOFF_CAP)
+    return random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * (2 ** attempt)))
+
+
+# google.api_core.exceptions のクラス名（エラー経路でもモジュールを import せずにクラス名で判定する）
+_RETRYABLE_API_ERRORS = frozenset({"ServiceUnavailable", "ResourceExhausted", "DeadlineExceeded"})
+_API_BUSY_ERRORS = frozenset({"ServiceUnavailable"})
+
+
+def _is_api_error(exc, class_names) -> bool:
+    """例外（または基底クラス）のクラス名が class_names に含まれるか"""
+    return any(cls.__name__ in class_names for cls in type(exc).__mro__)
+
+
+# ★ AI API エラーのユーザー向けメッセージ（例外クラス名 -> 文言、次に HTTP コードの部分一致で判定）
+_ERR_BY_CLS = {
+    "ServiceUnavailable": "⚠️ 現在、AIモデルが混雑しています (503 Error)。時間を置いて再度お試しください。",
+    "ResourceExhausted": "⚠️ API のリクエスト上限に達しました (429 Error)。時間を置いて再度お試しください。",
+    "Unauthenticated": "⚠️ API キーの認証に失敗しました。GOOGLE_API_KEY を確認してください。",
+    "PermissionDenied": "⚠️ API へのアクセス権限がありません。API キーの設定を確認してください。",
+}
+_ERR_BY_CODE = (
+    ("429", _ERR_BY_CLS["ResourceExhausted"]),
+    ("503", _ERR_BY_CLS["ServiceUnavailable"]),
+)
+
+
+def _friendly_ai_error_message(exc, action: str) -> str:
+    """AI 呼び出しの例外を表示用メッセージに変換（isinstance の連鎖ではなく辞書引き）"""
+    cls = type(exc).__name__
+    msg = str(exc)
+    return _ERR_BY_CLS.get(cls) or next(
+        (m for code, m in _ERR_BY_CODE if code in msg),
+        f"⚠️ {action}に失敗しました: {cls}: {msg}",
+    )
+
 
 def generate_content_with_retry(model, prompt, stream=True, retries=3):
     """503エラー対策のリトライ付き生成関数（レートリミッター統合）"""
@@ -84,41 +252,165 @@ def generate_content_with_retry(model, prompt, stream=True, retries=3):
                 raise RuntimeError("Rate limit timeout")
             rate_limiter.record_request()
             return model.generate_content(prompt, stream=stream)
-        except google_exceptions.ServiceUnavailable:
-            if i == retries - 1: raise
-            time.sleep(2 * (i + 1))
         except Exception as e:
-            if '429' in str(e) or 'rate' in str(e).lower():
+            if _is_api_error(e, _RETRYABLE_API_ERRORS):
                 if i == retries - 1: raise
-                time.sleep(5 * (i + 1))
+                time.sleep(_backoff_delay(i, e))
+            elif '429' in str(e) or 'rate' in str(e).lower():
+                if i == retries - 1: raise
+                time.sleep(_backoff_delay(i, e))
             else:
                 raise
     return None
 
 
+# =====================================================
+# LLM 応答のディスクキャッシュ（デモ/シナリオの同一プロンプトを再利用。実体は llm_cache モジュールで network_ops と共有）
+# =====================================================
+def _report_cache_get(key: str) -> str | None:
+    """レポート/復旧プランのキャッシュ参照（session_state -> SQLite の順。ディスクヒットはセッションへ反映）"""
+    session_cache = st.session_state.report_cache
+    if key in session_cache:
+        return session_cache[key]
+    text = llm_cache.get_report(key)
+    if text is not None:
+        session_cache[key] = text
+    return text
+
+
+def _report_cache_set(key: str, text: str, persist: bool = True) -> None:
+    """レポート/復旧プランを保存（persist=False ならセッション内のみ。失敗・部分応答はディスクに残さない）"""
+    st.session_state.report_cache[key] = text
+    if persist:
+        llm_cache.set_report(key, text)
+
+
+def cached_generate(model, prompt, stream=False):
+    """generate_content_with_retry のキャッシュ付き版（モデル名+正規化プロンプトのハッシュをキーにする）
+    stream=False ならテキスト、stream=True ならテキストチャンクのジェネレータを返す。
+    """
+    model_id = getattr(model, "model_name", "") or type(model).__name__
+    key = llm_cache.prompt_key(model_id, prompt)
+    cached = llm_cache.get_response(key)
+
+    if not stream:
+        if cached is not None:
+            return cached
+        response = generate_content_with_retry(model, prompt, stream=False)
+        if not response:
+            return None
+        text = response.text if hasattr(response, "text") else str(response)
+        if text.strip():
+            llm_cache.set_response(key, text)
+        return text
+
+    def _replay_or_stream():
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        for chunk in generate_content_with_retry(model, prompt, stream=True) or ():
+            t = _safe_chunk_text(chunk)
+            if t:
+                parts.append(t)
+                yield t
+        text = "".join(parts)
+        if text.strip():  # 完走した応答のみ保存
+            llm_cache.set_response(key, text)
+
+    return _replay_or_stream()
+
+
+class _StreamBuffer:
+    """ストリーミング受信テキストをリストに蓄積し、STREAM_FLUSH_INTERVAL ごとにまとめて描画する"""
+    __slots__ = ("_parts", "_placeholder", "_last_flush")
+
+    def __init__(self, placeholder):
+        self._parts: list[str] = []
+        self._placeholder = placeholder
+        self._last_flush = time.monotonic()
+
+    def append(self, piece: str) -> None:
+        if not piece:
+            return
+        self._parts.append(piece)
+        now = time.monotonic()
+        if now - self._last_flush >= STREAM_FLUSH_INTERVAL:
+            self._placeholder.markdown("".join(self._parts))  # 段階的に更新（一定間隔で間引き）
+            self._last_flush = now
+
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def flush(self) -> str:
+        """最終フラッシュ。連結済みテキストを返す"""
+        text = self.text()
+        self._placeholder.markdown(text)
+        return text
+
+
+_HASH_BLAKE2_THRESHOLD = 64 * 1024
+
+
 def _hash_text(text: str) -> str:
-    """テキストのハッシュ値を計算"""
-    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()[:16]
+    """テキストのハッシュ値を計算（毎回計算する。長文をキーに保持するメモ化はしない）"""
+    data = (text or "").encode("utf-8")
+    if len(data) > _HASH_BLAKE2_THRESHOLD:
+        # 長文は blake2b(8byte) で直接16桁を得る（SHA-256 を切り詰めるより高速）
+        return hashlib.blake2b(data, digest_size=8).hexdigest()
+    # 短文は blake2s(8byte)。暗号強度は不要なキャッシュキー用途のため SHA-256 より軽量なものを使う
+    return hashlib.blake2s(data, digest_size=8).hexdigest()
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _verify_log_cached(log_digest: bytes, _log_text: str) -> dict:
+    """verify_log_content のメモ化版（同一ログの再パースを回避）
+    キーはログ本文ではなくダイジェストのみ（_log_text は st.cache_data のハッシュ対象外）。
+    """
+    return verify_log_content(_log_text)
+
+
+def _verify_log(log_text: str) -> dict:
+    """ログ検証（blake2b ダイジェストをキーにキャッシュ）"""
+    digest = hashlib.blake2b((log_text or "").encode("utf-8"), digest_size=8).digest()
+    return _verify_log_cached(digest, log_text)
 
 
-def _pick_first(mapping: dict, keys: list[str], default: str = "") -> str:
+# ★ CIメタデータのキー揺れ候補（呼び出しごとのリスト生成を避けるため定数化）
+_KEYS_HOSTNAME = ("hostname", "host", "name")
+_KEYS_VENDOR = ("vendor", "manufacturer", "maker", "brand")
+_KEYS_OS = ("os", "platform", "os_name", "software", "sw")
+_KEYS_MODEL = ("model", "hw_model", "product", "sku")
+_KEYS_ROLE = ("role", "type", "device_role")
+_KEYS_LAYER = ("layer", "level", "network_layer")
+_KEYS_SITE = ("site", "dc", "datacenter", "location")
+_KEYS_TENANT = ("tenant", "customer", "org", "company")
+_KEYS_MGMT_IP = ("mgmt_ip", "management_ip", "management", "oob_ip")
+
+
+def _pick_first(mapping: dict, keys: tuple, default: str = "") -> str:
     """Return the first non-empty value for the given keys from mapping (stringify scalars)."""
+    get = mapping.get
     for k in keys:
-        try:
-            v = mapping.get(k, None)
-        except Exception:
-            v = None
+        v = get(k)
         if v is None:
             continue
-        if isinstance(v, (int, float, bool)):
-            s = str(v)
-            if s:
-                return s
-        elif isinstance(v, str):
-            if v.strip():
-                return v.strip()
+        if isinstance(v, str):
+            v = v.strip()
+            if v:
+                return v
+        elif isinstance(v, (int, float, bool)):
+            return str(v)
         else:
-            # for non-string, try json
+            # for non-string, try json (orjson があれば優先。非対応型は標準 json へ)
+            if orjson is not None:
+                try:
+                    s = orjson.dumps(v).decode("utf-8")
+                    if s and s != "null":
+                        return s
+                    continue
+                except TypeError:
+                    pass
             try:
                 s = json.dumps(v, ensure_ascii=False)
                 if s and s != "null":
@@ -135,15 +427,15 @@ def _build_ci_context_for_chat(target_node_id: str) -> dict:
 
     ci = {
         "device_id": target_node_id or "",
-        "hostname": _pick_first(md, ["hostname", "host", "name"], default=(target_node_id or "")),
-        "vendor": _pick_first(md, ["vendor", "manufacturer", "maker", "brand"], default=""),
-        "os": _pick_first(md, ["os", "platform", "os_name", "software", "sw"], default=""),
-        "model": _pick_first(md, ["model", "hw_model", "product", "sku"], default=""),
-        "role": _pick_first(md, ["role", "type", "device_role"], default=""),
-        "layer": _pick_first(md, ["layer", "level", "network_layer"], default=""),
-        "site": _pick_first(md, ["site", "dc", "datacenter", "location"], default=""),
-        "tenant": _pick_first(md, ["tenant", "customer", "org", "company"], default=""),
-        "mgmt_ip": _pick_first(md, ["mgmt_ip", "management_ip", "management", "oob_ip"], default=""),
+        "hostname": _pick_first(md, _KEYS_HOSTNAME, default=(target_node_id or "")),
+        "vendor": _pick_first(md, _KEYS_VENDOR, default=""),
+        "os": _pick_first(md, _KEYS_OS, default=""),
+        "model": _pick_first(md, _KEYS_MODEL, default=""),
+        "role": _pick_first(md, _KEYS_ROLE, default=""),
+        "layer": _pick_first(md, _KEYS_LAYER, default=""),
+        "site": _pick_first(md, _KEYS_SITE, default=""),
+        "tenant": _pick_first(md, _KEYS_TENANT, default=""),
+        "mgmt_ip": _pick_first(md, _KEYS_MGMT_IP, default=""),
         "interfaces": md.get("interfaces", ""),
     }
 
@@ -158,33 +450,170 @@ def _build_ci_context_for_chat(target_node_id: str) -> dict:
     return ci
 
 
+@st.cache_resource
+def _get_chat_model(api_key: str):
+    """チャット用モデル（rerun/チャットクリアを跨いで再利用し、gRPC 接続を温存）"""
+    import google.generativeai as genai  # 遅延インポート（チャット利用時のみ）
+    genai.configure(api_key=api_key, transport="grpc")
+    return genai.GenerativeModel("gemma-3-12b-it")
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _build_ci_context_for_chat_cached(target_node_id: str, topology_version: int, config_mtime_ns: int | None) -> dict:
+    """_build_ci_context_for_chat のメモ化版（引数の版数・mtime はキャッシュキー用）"""
+    return _build_ci_context_for_chat(target_node_id)
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _build_topology_context(node_id: str, topology_version: int) -> dict:
+    """レポート用のトポロジー文脈（ノード本体・親・子）。topology_version はキャッシュキー用"""
+    t_node = TOPOLOGY.get(node_id)
+    return {
+        "node": asdict(t_node) if t_node else {},
+        "parent_id": t_node.parent_id if t_node else None,
+        "children_ids": list(get_topology_index(TOPOLOGY).children.get(node_id, ())),
+    }
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _topology_context_digest(node_id: str, topology_version: int) -> str:
+    """トポロジー文脈のキャッシュキー用ダイジェスト（JSON 化せず要素を順に blake2s へ投入）"""
+    ctx = _build_topology_context(node_id, topology_version)
+    h = hashlib.blake2s(digest_size=8)
+    node = ctx["node"]
+    for k in sorted(node):
+        h.update(k.encode("utf-8"))
+        h.update(b"\x00")
+        h.update(repr(node[k]).encode("utf-8"))
+        h.update(b"\x00")
+    h.update(repr(ctx["parent_id"]).encode("utf-8"))
+    for cid in sorted(ctx["children_ids"]):
+        h.update(b"\x00")
+        h.update(cid.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _get_ci_context_for_chat(target_node_id: str) -> dict:
+    """チャット用CIコンテキスト（対象・トポロジー版数・Config の mtime が同じならセッションを跨いで再利用）"""
+    located = _locate_config(target_node_id)
+    return _build_ci_context_for_chat_cached(target_node_id, topology_data.TOPOLOGY_VERSION, located[1] if located else None)
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _ci_context_json_cached(target_node_id: str, topology_version: int, config_mtime_ns: int | None) -> str:
+    """チャットプロンプト埋め込み用の CI JSON（indent=2）。送信ごとの再シリアライズを避ける"""
+    ci = _build_ci_context_for_chat_cached(target_node_id, topology_version, config_mtime_ns)
+    if orjson is not None:
+        try:
+            return orjson.dumps(ci, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass  # orjson が扱えない値は標準 json にフォールバック
+    return json.dumps(ci, ensure_ascii=False, indent=2)
+
+
+def _get_ci_context_json_for_chat(target_node_id: str) -> str:
+    """_get_ci_context_for_chat の JSON 文字列版（キャッシュキーは同じ）"""
+    if not target_node_id:
+        return "{}"
+    located = _locate_config(target_node_id)
+    return _ci_context_json_cached(target_node_id, topology_data.TOPOLOGY_VERSION, located[1] if located else None)
+
+
 def _safe_chunk_text(chunk) -> str:
     """google.generativeai の stream chunk から安全にテキストを取り出します。"""
-    # chunk.text は ValueError になり得る
-    try:
-        t = getattr(chunk, "text", "")
-        if t:
-            return t
-    except Exception:
-        pass
+    # ★ candidates -> content -> parts を先に見る（chunk.text プロパティの検証・例外経路を回避）
+    cands = getattr(chunk, "candidates", None)
+    if cands:
+        content = getattr(cands[0], "content", None)
+        parts = getattr(content, "parts", None)
+        if parts:
+            if len(parts) == 1:
+                return getattr(parts[0], "text", "") or ""
+            return "".join(tx for tx in (getattr(p, "text", "") for p in parts) if tx)
 
-    # candidates -> content -> parts から拾う
+    # フォールバック: chunk.text は ValueError になり得る
     try:
-        cands = getattr(chunk, "candidates", None) or []
-        if not cands:
-            return ""
-        content = getattr(cands[0], "content", None)
-        parts = getattr(content, "parts", None) or []
-        out = []
-        for p in parts:
-            tx = getattr(p, "text", "")
-            if tx:
-                out.append(tx)
-        return "".join(out)
+        return getattr(chunk, "text", "") or ""
     except Exception:
         return ""
 
 
+# ★ 疑似診断ログのテンプレート（シナリオタグ -> ログ行）。呼び出しごとの分岐・リスト生成を避ける
+_LOG_RECOVERED: dict[str, tuple[str, ...]] = {
+    "FW": (
+        "show chassis cluster status",
+        "Redundancy group 0: healthy",
+        "control link: up",
+        "fabric link: up",
+    ),
+    "WAN": (
+        "show ip interface brief",
+        "GigabitEthernet0/0 up up",
+        "show ip bgp summary",
+        "Neighbor 203.0.113.2 Established",
+        "ping 203.0.113.2 repeat 5",
+        "Success rate is 100 percent (5/5)",
+    ),
+    "L2SW": (
+        "show environment",
+        "Fan: OK",
+        "Temperature: OK",
+        "show interface status",
+        "Uplink: up",
+    ),
+    "DEFAULT": (
+        "show system alarms",
+        "No active alarms",
+        "ping 8.8.8.8 repeat 5",
+        "Success rate is 100 percent (5/5)",
+    ),
+}
+
+_LOG_FAULTED: dict[str, tuple[str, ...]] = {
+    "WAN": (
+        "show ip interface brief",
+        "GigabitEthernet0/0 down down",
+        "show ip bgp summary",
+        "Neighbor 203.0.113.2 Idle",
+        "ping 203.0.113.2 repeat 5",
+        "Success rate is 0 percent (0/5)",
+    ),
+    "FW": (
+        "show chassis cluster status",
+        "Redundancy group 0: degraded",
+        "control link: down",
+        "fabric link: up",
+    ),
+    "L2SW": (
+        "show environment",
+        "Fan: FAIL",
+        "Temperature: HIGH",
+        "show interface status",
+        "Uplink: flapping",
+    ),
+    "DEFAULT": (
+        "show system alarms",
+        "No active alarms",
+    ),
+}
+
+# 復旧後は部分一致（"18. [Complex] 同時多発：FW & AP" も FW 扱い）、障害中はタグ/名称一致で判定
+# ※ シナリオ名に複数タグが混在しないため、優先順ではなく先頭一致で十分
+_RECOVERED_TAG_RE = re.compile(r"(FW)|(WAN)|(L2SW)")
+_FAULTED_TAG_RE = re.compile(r"(WAN全回線断|\[WAN\])|(FW片系障害|\[FW\])|(L2SW)")
+_TAG_BY_GROUP = {
+    _RECOVERED_TAG_RE: ("FW", "WAN", "L2SW"),
+    _FAULTED_TAG_RE: ("WAN", "FW", "L2SW"),
+}
+
+
+def _scenario_tag(selected_scenario: str, recovered: bool = False) -> str:
+    """シナリオ名を疑似ログテンプレートのタグ（WAN/FW/L2SW/DEFAULT）に正規化"""
+    pattern = _RECOVERED_TAG_RE if recovered else _FAULTED_TAG_RE
+    m = pattern.search(selected_scenario or "")
+    if m is None:
+        return "DEFAULT"
+    return _TAG_BY_GROUP[pattern][m.lastindex - 1]
 
 
 def run_diagnostic_simulation_no_llm(selected_scenario, target_node_obj):
@@ -206,75 +635,10 @@ def run_diagnostic_simulation_no_llm(selected_scenario, target_node_obj):
 
     if recovered_devices.get(device_id) and recovered_map.get(device_id) == selected_scenario:
         # "復旧後"の疑似ログ（成功）
-        if "FW" in selected_scenario:
-            lines += [
-                "show chassis cluster status",
-                "Redundancy group 0: healthy",
-                "control link: up",
-                "fabric link: up",
-            ]
-        elif "WAN" in selected_scenario or "WAN全回線断" in selected_scenario:
-            lines += [
-                "show ip interface brief",
-                "GigabitEthernet0/0 up up",
-                "show ip bgp summary",
-                "Neighbor 203.0.113.2 Established",
-                "ping 203.0.113.2 repeat 5",
-                "Success rate is 100 percent (5/5)",
-            ]
-        elif "L2SW" in selected_scenario:
-            lines += [
-                "show environment",
-                "Fan: OK",
-                "Temperature: OK",
-                "show interface status",
-                "Uplink: up",
-            ]
-        else:
-            lines += [
-                "show system alarms",
-                "No active alarms",
-                "ping 8.8.8.8 repeat 5",
-                "Success rate is 100 percent (5/5)",
-            ]
-
-        return {
-            "status": "SUCCESS",
-            "sanitized_log": "\n".join(lines),
-            "verification_log": "N/A",
-            "device_id": device_id,
-        }
-
-    # "障害中"の疑似ログ（現状維持）
-    if "WAN全回線断" in selected_scenario or "[WAN]" in selected_scenario:
-        lines += [
-            "show ip interface brief",
-            "GigabitEthernet0/0 down down",
-            "show ip bgp summary",
-            "Neighbor 203.0.113.2 Idle",
-            "ping 203.0.113.2 repeat 5",
-            "Success rate is 0 percent (0/5)",
-        ]
-    elif "FW片系障害" in selected_scenario or "[FW]" in selected_scenario:
-        lines += [
-            "show chassis cluster status",
-            "Redundancy group 0: degraded",
-            "control link: down",
-            "fabric link: up",
-        ]
-    elif "L2SW" in selected_scenario:
-        lines += [
-            "show environment",
-            "Fan: FAIL",
-            "Temperature: HIGH",
-            "show interface status",
-            "Uplink: flapping",
-        ]
+        lines.extend(_LOG_RECOVERED[_scenario_tag(selected_scenario, recovered=True)])
     else:
-        lines += [
-            "show system alarms",
-            "No active alarms",
-        ]
+        # "障害中"の疑似ログ（現状維持）
+        lines.extend(_LOG_FAULTED[_scenario_tag(selected_scenario)])
 
     return {
         "status": "SUCCESS",
@@ -284,43 +648,65 @@ def run_diagnostic_simulation_no_llm(selected_scenario, target_node_obj):
     }
 
 
-def _hash_text(text: str) -> str:
-    import hashlib
-    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()[:16]
-
-def _extract_first_codeblock_after_heading(markdown_text: str, heading_keyword: str) -> str:
-    """Extract the first fenced code block (``` ... ```) that appears *after* a heading containing heading_keyword.
-    - Returns code content without fences.
-    - If not found, returns empty string.
-    This is intentionally simple and robust to avoid complex parsing / IF sprawl.
+def _topology_render_keys(alarms, root_cause_candidates) -> tuple:
+    """描画結果キャッシュのキー (alarms_key, cands_key)
+
+    描画が実際に参照する項目（アラームの device_id、候補の id/type）だけを要約するため、
+    メッセージ・重大度・確率だけが変わった rerun でもキャッシュが当たる。
     """
-    if not markdown_text or not heading_keyword:
-        return ""
-    # Find the heading position (supports '#', '##', etc. and also plain text headings)
-    idx = markdown_text.find(heading_keyword)
-    if idx < 0:
-        return ""
-    tail = markdown_text[idx:]
-    # Find first fenced code block after the heading
-    m = re.search(r"```[a-zA-Z0-9_+-]*\s*\n(.*?)\n```", tail, flags=re.DOTALL)
-    if not m:
-        return ""
-    return (m.group(1) or "").strip()
-def render_topology(alarms, root_cause_candidates):
-    """トポロジー図の描画 (AI判定結果を反映)"""
+    alarms_key = _hash_text(repr((topology_data.TOPOLOGY_VERSION, sorted({a.device_id for a in alarms}))))
+    cands_key = _hash_text(repr(sorted((str(c.get('id')), str(c.get('type'))) for c in root_cause_candidates)))
+    return alarms_key, cands_key
+
+
+def render_topology(alarms, root_cause_candidates, input_digest: bytes | None = None) -> str:
+    """トポロジー図の描画 (AI判定結果を反映)
+
+    DOT ソース文字列を返す（st.graphviz_chart は文字列も受け付ける）。
+    input_digest（アラーム/解析結果の事前ダイジェスト）が直前と同じ rerun では、
+    入力リストを走査せずバイト列比較のみで返す。それ以外も st.cache_data で共有する。
+    """
+    cached = st.session_state.get("_topology_dot_cache")
+    if input_digest is not None and cached and cached[0] == input_digest:
+        return cached[2]
+    cache_key = _topology_render_keys(alarms, root_cause_candidates)
+    if cached and cached[1] == cache_key:
+        source = cached[2]
+    else:
+        source = _render_topology_cached(*cache_key, alarms, root_cause_candidates)
+    st.session_state["_topology_dot_cache"] = (input_digest, cache_key, source)
+    return source
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _render_topology_cached(alarms_key: str, cands_key: str, _alarms, _root_cause_candidates) -> str:
+    """alarms_key / cands_key（入力のダイジェスト）のみをキーに DOT ソースを保持"""
+    return _build_topology_graph(_alarms, _root_cause_candidates).source
+
+
+def _build_topology_graph(alarms, root_cause_candidates):
+    """Graphviz の Digraph を構築"""
+    import graphviz  # 遅延インポート（コールドスタート短縮）
     graph = graphviz.Digraph()
     graph.attr(rankdir='TB')
     graph.attr('node', shape='box', style='rounded,filled', fontname='Helvetica')
     
-    alarm_map = {a.device_id: a for a in alarms}
-    alarmed_ids = set(alarm_map.keys())
-    
-    root_cause_ids = {c['id'] for c in root_cause_candidates if c['prob'] > 0.6}
+    alarmed_ids = {a.device_id for a in alarms}
     
-    # AI判定結果のマッピング
+    # AI判定結果のマッピング（未使用だった root_cause_ids の別走査は廃止）
     node_status_map = {c['id']: c['type'] for c in root_cause_candidates}
     
+    # ★ 冗長グループ -> メンバー の索引で相方を引く（O(N²) の全走査を回避）
+    redundancy_peers = get_topology_index(TOPOLOGY).redundancy_peers
+    edges = []
+    
+    # ★ ノードとエッジを TOPOLOGY の1回の走査で組み立てる（エッジは DOT の出力順を保つため後でまとめて追加）
     for node_id, node in TOPOLOGY.items():
+        if node.parent_id:
+            edges.append((node.parent_id, node_id))
+            for partner_id in redundancy_peers.get(node.parent_id, ()):
+                edges.append((partner_id, node_id))
+
         color = "#e8f5e9"
         penwidth = "1"
         fontcolor = "black"
@@ -346,17 +732,32 @@ def render_topology(alarms, root_cause_candidates):
         
         graph.node(node_id, label=label, fillcolor=color, color='black', penwidth=penwidth, fontcolor=fontcolor)
     
-    for node_id, node in TOPOLOGY.items():
-        if node.parent_id:
-            graph.edge(node.parent_id, node_id)
-            parent_node = TOPOLOGY.get(node.parent_id)
-            if parent_node and parent_node.redundancy_group:
-                partners = [n.id for n in TOPOLOGY.values() 
-                           if n.redundancy_group == parent_node.redundancy_group and n.id != parent_node.id]
-                for partner_id in partners:
-                    graph.edge(partner_id, node_id)
+    for tail, head in edges:
+        graph.edge(tail, head)
+
     return graph
 
+# --- ボタンコールバック（on_click で状態更新し、追加の st.rerun を不要にする） ---
+def _on_regenerate_report():
+    st.session_state.generated_report = None
+
+
+def _on_cancel_remediation():
+    st.session_state.pop("remediation_plan", None)
+    st.session_state.verification_log = None
+
+
+def _on_reset_demo():
+    st.session_state.pop("remediation_plan", None)
+    st.session_state.verification_log = None
+    st.session_state.current_scenario = "正常稼働"
+    st.session_state.balloons_shown = False  # バルーンフラグもリセット
+
+
+def _on_clear_chat():
+    st.session_state.messages = []
+
+
 # --- UI構築 ---
 st.title("⚡ Antigravity Autonomous Agent")
 
@@ -369,14 +770,7 @@ else:
 # --- サイドバー ---
 with st.sidebar:
     st.header("⚡ Scenario Controller")
-    SCENARIO_MAP = {
-        "基本・広域障害": ["正常稼働", "1. WAN全回線断", "2. FW片系障害", "3. L2SWサイレント障害"],
-        "WAN Router": ["4. [WAN] 電源障害：片系", "5. [WAN] 電源障害：両系", "6. [WAN] BGPルートフラッピング", "7. [WAN] FAN故障", "8. [WAN] メモリリーク"],
-        "Firewall (Juniper)": ["9. [FW] 電源障害：片系", "10. [FW] 電源障害：両系", "11. [FW] FAN故障", "12. [FW] メモリリーク"],
-        "L2 Switch": ["13. [L2SW] 電源障害：片系", "14. [L2SW] 電源障害：両系", "15. [L2SW] FAN故障", "16. [L2SW] メモリリーク"],
-        "複合・その他": ["17. [WAN] 複合障害：電源＆FAN", "18. [Complex] 同時多発：FW & AP", "99. [Live] Cisco実機診断"]
-    }
-    selected_category = st.selectbox("対象カテゴリ:", list(SCENARIO_MAP.keys()))
+    selected_category = st.selectbox("対象カテゴリ:", SCENARIO_CATEGORIES)
     selected_scenario = st.radio("発生シナリオ:", SCENARIO_MAP[selected_category])
     st.markdown("---")
     if api_key: 
@@ -390,37 +784,45 @@ with st.sidebar:
         if user_key: api_key = user_key
 
 # --- セッション管理 ---
-if "current_scenario" not in st.session_state:
-    st.session_state.current_scenario = "正常稼働"
+# ★ 既定値は setdefault で一括適用（可変オブジェクトはセッション間で共有しないようファクトリで生成）
+_SESSION_DEFAULTS = (
+    ("current_scenario", "正常稼働"),
+    ("live_result", None),
+    ("chat_session", None),
+    ("verification_result", None),
+    ("generated_report", None),
+    ("verification_log", None),
+    ("last_report_cand_id", None),
+    ("logic_engine", None),
+    ("balloons_shown", False),
+)
+_SESSION_DEFAULT_FACTORIES = (
+    ("messages", list),
+    ("report_cache", dict),
+    ("recovered_devices", dict),       # 復旧状態（デモ用）
+    ("recovered_scenario_map", dict),
+    ("global_cache", dict),            # ★パフォーマンス改善：グローバルキャッシュ
+)
 
-# 変数初期化
-for key in ["live_result", "messages", "chat_session", "trigger_analysis", "verification_result", "generated_report", "verification_log", "last_report_cand_id", "logic_engine", "recovered_devices", "recovered_scenario_map", "balloons_shown", "report_cache"]:
+for key, value in _SESSION_DEFAULTS:
+    st.session_state.setdefault(key, value)
+for key, factory in _SESSION_DEFAULT_FACTORIES:
     if key not in st.session_state:
-        if key == "messages":
-            st.session_state[key] = []
-        elif key in ["trigger_analysis", "balloons_shown"]:
-            st.session_state[key] = False
-        elif key == "report_cache":
-            st.session_state[key] = {}
-        else:
-            st.session_state[key] = None
+        st.session_state[key] = factory()
 
+GLOBAL_CACHE = st.session_state.global_cache
 
-# 復旧状態（デモ用）
-if "recovered_devices" not in st.session_state:
-    st.session_state.recovered_devices = {}
-if "recovered_scenario_map" not in st.session_state:
-    st.session_state.recovered_scenario_map = {}
 
-# ★パフォーマンス改善：グローバルキャッシュの初期化
-if "global_cache" not in st.session_state:
-    st.session_state.global_cache = {}
+@st.cache_resource
+def _get_logic_engine(topology_version: int) -> LogicalRCA:
+    """全セッションで共有する推論エンジン（analyze は入力アラーム以外の状態を持たない。
+    インスタンス上で変化するのは冪等な API 初期化のみ）。topology_version はキャッシュキー用"""
+    return LogicalRCA(TOPOLOGY)
 
-GLOBAL_CACHE = st.session_state.global_cache
 
 # エンジン初期化
 if not st.session_state.logic_engine:
-    st.session_state.logic_engine = LogicalRCA(TOPOLOGY)
+    st.session_state.logic_engine = _get_logic_engine(topology_data.TOPOLOGY_VERSION)
 
 # シナリオ切り替え時のリセット
 if st.session_state.current_scenario != selected_scenario:
@@ -431,131 +833,229 @@ if st.session_state.current_scenario != selected_scenario:
     st.session_state.messages = []      
     st.session_state.chat_session = None 
     st.session_state.live_result = None 
-    st.session_state.trigger_analysis = False
     st.session_state.verification_result = None
     st.session_state.generated_report = None
     st.session_state.verification_log = None 
     st.session_state.last_report_cand_id = None
     st.session_state.balloons_shown = False  # バルーンフラグもリセット
     if "remediation_plan" in st.session_state: del st.session_state.remediation_plan
-    st.rerun()
 
-# ==========================================
-# メインロジック
-# ==========================================
-alarms = []
-target_device_id = None
-root_severity = "CRITICAL"
-is_live_mode = False
+# =====================================================
+# シナリオ -> アラーム生成ハンドラ
+# 各ハンドラは (topology, scenario) を受け取り (alarms, target_device_id, root_severity) を返す
+# =====================================================
+def _scenario_live(topology, scenario):
+    return [], None, "CRITICAL"
 
-# 1. アラーム生成ロジック
-if "Live" in selected_scenario: is_live_mode = True
-elif "WAN全回線断" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
-    if target_device_id: alarms = simulate_cascade_failure(target_device_id, TOPOLOGY)
-elif "FW片系障害" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
+
+def _scenario_wan_down(topology, scenario):
+    target_device_id = _find_target_cached(topology, node_type="ROUTER")
+    alarms = simulate_cascade_failure(target_device_id, topology) if target_device_id else []
+    return alarms, target_device_id, "CRITICAL"
+
+
+def _scenario_fw_partial(topology, scenario):
+    target_device_id = _find_target_cached(topology, node_type="FIREWALL")
     if target_device_id:
-        alarms = [Alarm(target_device_id, "Heartbeat Loss", "WARNING")]
-        root_severity = "WARNING"
+        return [Alarm(target_device_id, "Heartbeat Loss", "WARNING")], target_device_id, "WARNING"
+    return [], target_device_id, "CRITICAL"
+
 
-elif "L2SWサイレント障害" in selected_scenario:
+def _scenario_l2sw_silent(topology, scenario):
     target_device_id = "L2_SW_01"
-    if target_device_id not in TOPOLOGY:
-        target_device_id = find_target_node_id(TOPOLOGY, keyword="L2_SW")
-    if target_device_id and target_device_id in TOPOLOGY:
-        child_nodes = [nid for nid, n in TOPOLOGY.items() if n.parent_id == target_device_id]
-        alarms = [Alarm(child, "Connection Lost", "CRITICAL") for child in child_nodes]
-    else:
-        st.error("Error: L2 Switch definition not found")
+    if target_device_id not in topology:
+        target_device_id = _find_target_cached(topology, keyword="L2_SW")
+    if target_device_id and target_device_id in topology:
+        child_nodes = get_topology_index(topology).children.get(target_device_id, ())
+        return [Alarm(child, "Connection Lost", "CRITICAL") for child in child_nodes], target_device_id, "CRITICAL"
+    st.error("Error: L2 Switch definition not found")
+    return [], target_device_id, "CRITICAL"
+
 
-elif "複合障害" in selected_scenario:
-    target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
+def _scenario_compound(topology, scenario):
+    target_device_id = _find_target_cached(topology, node_type="ROUTER")
+    alarms = []
     if target_device_id:
         alarms = [
             Alarm(target_device_id, "Power Supply 1 Failed", "CRITICAL"),
             Alarm(target_device_id, "Fan Fail", "WARNING")
         ]
-elif "同時多発" in selected_scenario:
-    fw_node = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
-    ap_node = find_target_node_id(TOPOLOGY, node_type="ACCESS_POINT")
+    return alarms, target_device_id, "CRITICAL"
+
+
+def _scenario_simultaneous(topology, scenario):
+    fw_node = _find_target_cached(topology, node_type="FIREWALL")
+    ap_node = _find_target_cached(topology, node_type="ACCESS_POINT")
     alarms = []
     if fw_node: alarms.append(Alarm(fw_node, "Heartbeat Loss", "WARNING"))
     if ap_node: alarms.append(Alarm(ap_node, "Connection Lost", "CRITICAL"))
-    target_device_id = fw_node 
-else:
-    if "[WAN]" in selected_scenario: target_device_id = find_target_node_id(TOPOLOGY, node_type="ROUTER")
-    elif "[FW]" in selected_scenario: target_device_id = find_target_node_id(TOPOLOGY, node_type="FIREWALL")
-    elif "[L2SW]" in selected_scenario: target_device_id = find_target_node_id(TOPOLOGY, node_type="SWITCH", layer=4)
+    return alarms, fw_node, "CRITICAL"
+
+
+def _fault_psu_single(topology, target_device_id):
+    return [Alarm(target_device_id, "Power Supply 1 Failed", "WARNING")], "WARNING"
+
+
+def _fault_psu_dual(topology, target_device_id):
+    if "FW" in target_device_id:
+        return [Alarm(target_device_id, "Power Supply: Dual Loss (Device Down)", "CRITICAL")], "CRITICAL"
+    return simulate_cascade_failure(target_device_id, topology, "Power Supply: Dual Loss (Device Down)"), "CRITICAL"
+
+
+def _fault_bgp(topology, target_device_id):
+    return [Alarm(target_device_id, "BGP Flapping", "WARNING")], "WARNING"
+
+
+def _fault_fan(topology, target_device_id):
+    return [Alarm(target_device_id, "Fan Fail", "WARNING")], "WARNING"
+
+
+def _fault_memory(topology, target_device_id):
+    return [Alarm(target_device_id, "Memory High", "WARNING")], "WARNING"
+
+
+# 機器別シナリオの障害種別 -> アラーム生成
+_DEVICE_FAULT_BUILDERS = types.MappingProxyType({
+    "電源障害：片系": _fault_psu_single,
+    "電源障害：両系": _fault_psu_dual,
+    "BGP": _fault_bgp,
+    "FAN": _fault_fan,
+    "メモリ": _fault_memory,
+})
+_DEVICE_FAULT_RE = re.compile("|".join(map(re.escape, _DEVICE_FAULT_BUILDERS)))
+
+
+def _scenario_device_fault(topology, scenario):
+    """[WAN]/[FW]/[L2SW] の機器別シナリオ（該当なしのシナリオは空アラーム）"""
+    # ★ タグ・障害種別は起動時に解析済みの ScenarioMeta を引く（既知ラベルでは正規表現を走らせない）
+    meta = _SCENARIO_META.get(scenario) or _parse_scenario(scenario)
+    target_device_id = None
+    target_query = _SCENARIO_TARGET_QUERY.get(meta.tag)
+    if target_query:
+        target_device_id = _find_target_cached(topology, node_type=target_query[0], layer=target_query[1])
+    if not target_device_id:
+        return [], target_device_id, "CRITICAL"
+    if not meta.fault:
+        return [], target_device_id, "CRITICAL"
+    alarms, root_severity = _DEVICE_FAULT_BUILDERS[meta.fault](topology, target_device_id)
+    return alarms, target_device_id, root_severity
+
+
+# シナリオ名のキーワード -> ハンドラ（シナリオ名には1つしか含まれない）
+_SCENARIO_HANDLERS = types.MappingProxyType({
+    "Live": _scenario_live,
+    "WAN全回線断": _scenario_wan_down,
+    "FW片系障害": _scenario_fw_partial,
+    "L2SWサイレント障害": _scenario_l2sw_silent,
+    "複合障害": _scenario_compound,
+    "同時多発": _scenario_simultaneous,
+})
+_SCENARIO_KEY_RE = re.compile("|".join(map(re.escape, _SCENARIO_HANDLERS)))
 
-    if target_device_id:
-        if "電源障害：片系" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Power Supply 1 Failed", "WARNING")]
-            root_severity = "WARNING"
-        elif "電源障害：両系" in selected_scenario:
-            if "FW" in target_device_id:
-                alarms = [Alarm(target_device_id, "Power Supply: Dual Loss (Device Down)", "CRITICAL")]
-            else:
-                alarms = simulate_cascade_failure(target_device_id, TOPOLOGY, "Power Supply: Dual Loss (Device Down)")
-        elif "BGP" in selected_scenario:
-            alarms = [Alarm(target_device_id, "BGP Flapping", "WARNING")]
-            root_severity = "WARNING"
-        elif "FAN" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Fan Fail", "WARNING")]
-            root_severity = "WARNING"
-        elif "メモリ" in selected_scenario:
-            alarms = [Alarm(target_device_id, "Memory High", "WARNING")]
-            root_severity = "WARNING"
+
+class ScenarioMeta(NamedTuple):
+    """シナリオ名の解析結果（rerun ごとに一度だけ算出して使い回す）"""
+    is_live: bool
+    key: str | None   # _SCENARIO_HANDLERS のキー（None は機器別シナリオ）
+    tag: str | None   # [WAN] / [FW] / [L2SW] 等のタグ
+    fault: str | None  # _DEVICE_FAULT_BUILDERS のキー（機器別シナリオの障害種別）
+
+
+def _parse_scenario(scenario: str) -> ScenarioMeta:
+    key_match = _SCENARIO_KEY_RE.search(scenario)
+    tag_match = _SCENARIO_TAG_RE.search(scenario)
+    key = key_match.group(0) if key_match else None
+    tag = tag_match.group(1) if tag_match else None
+    fault_match = _DEVICE_FAULT_RE.search(scenario)
+    fault = fault_match.group(0) if fault_match else None
+    return ScenarioMeta(is_live=(key == "Live" or tag == "Live"), key=key, tag=tag, fault=fault)
+
+
+# ★ ラジオの選択肢（SCENARIO_MAP の全ラベル）は固定なので、解析結果とハンドラを起動時に一度だけ解決する
+_SCENARIO_TO_CATEGORY = types.MappingProxyType({
+    name: category for category, names in SCENARIO_MAP.items() for name in names
+})
+_SCENARIO_META = types.MappingProxyType({
+    name: _parse_scenario(name) for name in _SCENARIO_TO_CATEGORY
+})
+_SCENARIO_BUILDERS = types.MappingProxyType({
+    name: _SCENARIO_HANDLERS.get(meta.key, _scenario_device_fault) for name, meta in _SCENARIO_META.items()
+})
+
+
+# ==========================================
+# メインロジック
+# ==========================================
+# 1. アラーム生成ロジック
+# ★ 選択ラベルで解析結果・ハンドラを辞書引き（未知のラベルのみ正規表現で解決）
+scenario_meta = _SCENARIO_META.get(selected_scenario) or _parse_scenario(selected_scenario)
+scenario_builder = _SCENARIO_BUILDERS.get(selected_scenario) or _SCENARIO_HANDLERS.get(scenario_meta.key, _scenario_device_fault)
+alarms, target_device_id, root_severity = scenario_builder(TOPOLOGY, selected_scenario)
 
 # 2. 推論エンジンによる分析
-analysis_results = st.session_state.logic_engine.analyze(alarms)
+# 正常稼働時（アラーム無し）は推論エンジンを呼ばずに固定結果を使う
+# ★ アラーム構成が前回と同じなら推論結果を再利用（行選択・チャット送信などの rerun で再推論しない）
+# ★ 解析結果はアラーム構成の関数なので、そのダイジェスト（bytes）を下流キャッシュの比較キーとして保持する
+if not alarms:
+    analysis_results = [dict(NO_ALERT_RESULT)]
+    analysis_digest = b""
+else:
+    alarm_key = _hash_text(selected_scenario + "|" + "|".join(f"{a.device_id},{a.message},{a.severity}" for a in alarms))
+    cached_analysis = st.session_state.get("_analyze_cache")
+    if cached_analysis and cached_analysis[0] == alarm_key:
+        analysis_results = cached_analysis[1]
+    else:
+        analysis_results = st.session_state.logic_engine.analyze(alarms)
+        st.session_state["_analyze_cache"] = (alarm_key, analysis_results)
+    analysis_digest = bytes.fromhex(alarm_key)
 
 # 3. コックピット表示
 selected_incident_candidate = None
 
-st.markdown("### 🛡️ AIOps インシデント・コックピット")
-col1, col2, col3 = st.columns(3)
-with col1: st.metric("📉 ノイズ削減率", "98.5%", "高効率稼働中")
-with col2: st.metric("📨 処理アラーム数", f"{len(alarms) * 15 if alarms else 0}件", "抑制済")
-with col3: st.metric("🚨 要対応インシデント", f"{len([c for c in analysis_results if c['prob'] > 0.6])}件", "対処が必要")
-st.markdown("---")
-
-df_data = []
 # ★修正: スライス制限を撤廃 (全件表示)
 # 階層ロジックにより、重要なもの(Tier高)が先頭に来るため、大量にあっても問題ない
-for rank, cand in enumerate(analysis_results, 1):
-    status = "⚪ 監視中"
-    action = "👁️ 静観"
-    
-    if cand['prob'] > 0.8:
-        status = "🔴 危険 (根本原因)"
-        action = "🚀 自動修復が可能"
-    elif cand['prob'] > 0.6:
-        status = "🟡 警告 (被疑箇所)"
-        action = "🔍 詳細調査を推奨"
-    
-    if "Network/Unreachable" in cand['type'] or "Network/Secondary" in cand['type']:
-        status = "⚫ 応答なし (上位障害)"
-        action = "⛔ 対応不要 (上位復旧待ち)"
-
-    candidate_text = f"デバイス: {cand['id']} / 原因: {cand['label']}"
-    if cand.get('verification_log'):
-        candidate_text += " [🔍 Active Probe: 応答なし]"
-    
-    # デバッグ用にTierを表示（本番では消しても良い）
-    # candidate_text += f" (Tier: {cand.get('tier')})"
-
-    df_data.append({
-        "順位": rank,
-        "ステータス": status,
+# ★ 行ごとの dict 組み立てをやめ、列単位（pandas/NumPy）で一括算出する
+if analysis_results:
+    src = pd.DataFrame.from_records(analysis_results)
+    # ★ 閾値判定は ndarray 上のブールマスクで行い、np.select に直接渡す（Series の index 整列を介さない）
+    prob = src["prob"].to_numpy(dtype=np.float64)
+    unreachable = src["type"].astype(str).str.contains("Network/Unreachable|Network/Secondary", regex=True).to_numpy()
+    high = prob > 0.8
+    mid = prob > 0.6
+    incident_count = int(np.count_nonzero(mid))
+    conds = [unreachable, high, mid]  # 優先順: 上位障害 > 危険 > 警告
+    status = np.select(conds, [STATUS_UNREACHABLE, STATUS_DANGER, STATUS_WARNING], default=STATUS_WATCH)
+    action = np.select(conds, [ACTION_WAIT_UPSTREAM, ACTION_AUTO_FIX, ACTION_INVESTIGATE], default=ACTION_WATCH)
+
+    candidate_text = "デバイス: " + src["id"].astype(str) + " / 原因: " + src["label"].astype(str)
+    if "verification_log" in src:
+        vlog = src["verification_log"]
+        has_probe = vlog.notna() & vlog.astype(bool)
+        candidate_text = candidate_text.where(~has_probe, candidate_text + " [🔍 Active Probe: 応答なし]")
+
+    # ★ 列は型を確定させた ndarray で渡し、pandas 側の dtype 推論を省く（表示は %.2f のため float32 で十分）
+    df = pd.DataFrame({
+        "順位": np.arange(1, len(src) + 1, dtype=np.int32),
+        # 取り得る値が数種類しかないためカテゴリ型で保持
+        "ステータス": pd.Categorical(status),
         "根本原因候補": candidate_text,
-        "リスクスコア": cand['prob'],
-        "推奨アクション": action,
-        "ID": cand['id'],
-        "Type": cand['type']
+        "リスクスコア": prob.astype(np.float32),
+        "推奨アクション": pd.Categorical(action),
     })
+else:
+    df = pd.DataFrame()
+    incident_count = 0
+
+st.markdown("### 🛡️ AIOps インシデント・コックピット")
+# メトリクス値は一度だけ算出（要対応件数は上で求めたマスクを集計）
+processed_alarm_count = len(alarms) * 15
+
+col1, col2, col3 = st.columns(3)
+with col1: st.metric("📉 ノイズ削減率", "98.5%", "高効率稼働中")
+with col2: st.metric("📨 処理アラーム数", f"{processed_alarm_count}件", "抑制済")
+with col3: st.metric("🚨 要対応インシデント", f"{incident_count}件", "対処が必要")
+st.markdown("---")
 
-df = pd.DataFrame(df_data)
 st.info("💡 障害発生状況は障害レポートから確認できます。障害レポート作成後に復旧プランを作成できます。")
 
 event = st.dataframe(
@@ -570,13 +1070,9 @@ event = st.dataframe(
     on_select="rerun"
 )
 
-if len(event.selection.rows) > 0:
-    idx = event.selection.rows[0]
-    sel_row = df.iloc[idx]
-    for res in analysis_results:
-        if res['id'] == sel_row['ID'] and res['type'] == sel_row['Type']:
-            selected_incident_candidate = res
-            break
+# 表は analysis_results と同じ順で構築しているため、選択行の位置でそのまま引ける
+if event.selection.rows:
+    selected_incident_candidate = analysis_results[event.selection.rows[0]]
 else:
     selected_incident_candidate = analysis_results[0] if analysis_results else None
 
@@ -587,22 +1083,8 @@ col_map, col_chat = st.columns([1.2, 1])
 # === 左カラム: トポロジーと診断 ===
 with col_map:
     st.subheader("🌐 Network Topology")
-    
-    current_root_node = None
-    current_severity = "WARNING"
-    
-    if selected_incident_candidate and selected_incident_candidate["prob"] > 0.6:
-        current_root_node = TOPOLOGY.get(selected_incident_candidate["id"])
-        if "Hardware/Physical" in selected_incident_candidate["type"] or "Critical" in selected_incident_candidate["type"] or "Silent" in selected_incident_candidate["type"]:
-            current_severity = "CRITICAL"
-        else:
-            current_severity = "WARNING"
 
-    elif target_device_id:
-        current_root_node = TOPOLOGY.get(target_device_id)
-        current_severity = root_severity
-
-    st.graphviz_chart(render_topology(alarms, analysis_results), use_container_width=True)
+    st.graphviz_chart(render_topology(alarms, analysis_results, analysis_digest), use_container_width=True)
 
     st.markdown("---")
     st.subheader("🛠️ Auto-Diagnostics")
@@ -614,7 +1096,7 @@ with col_map:
             with st.status("Agent Operating...", expanded=True) as status:
                 st.write("🔌 Connecting to device...")
                 target_node_obj = TOPOLOGY.get(target_device_id) if target_device_id else None
-                is_live_mode = bool(st.session_state.get('api_connected')) and ('[Live]' in selected_scenario or 'Live' in selected_scenario)
+                is_live_mode = bool(st.session_state.get('api_connected')) and scenario_meta.is_live
                 
                 res = run_diagnostic_simulation(selected_scenario, target_node_obj, api_key) if is_live_mode else run_diagnostic_simulation_no_llm(selected_scenario, target_node_obj)
                 st.session_state.live_result = res
@@ -623,15 +1105,14 @@ with col_map:
                     st.write("✅ Log Acquired & Sanitized.")
                     status.update(label="Diagnostics Complete!", state="complete", expanded=False)
                     log_content = res.get('sanitized_log', "")
-                    verification = verify_log_content(log_content)
+                    verification = _verify_log(log_content)
+                    # 診断結果は同一実行内の下段で表示されるため、追加の rerun は行わない
                     st.session_state.verification_result = verification
-                    st.session_state.trigger_analysis = True
                 elif res["status"] == "SKIPPED":
                     status.update(label="No Action Required", state="complete")
                 else:
                     st.write("❌ Connection Failed.")
                     status.update(label="Diagnostics Failed", state="error")
-            st.rerun()
 
     if st.session_state.live_result:
         res = st.session_state.live_result
@@ -672,49 +1153,32 @@ with col_chat:
                     
                     report_container = st.empty()
                     target_conf = load_config_by_id(cand['id'])
-                    
                     verification_context = cand.get("verification_log", "特になし")
-                    target_conf = load_config_by_id(cand['id'])
 
                     # CI/トポロジー情報
                     t_node = TOPOLOGY.get(cand["id"])
-                    t_node_dict = {
-    "id": getattr(t_node, "id", None),
-    "type": getattr(t_node, "type", None),
-    "layer": getattr(t_node, "layer", None),
-    "metadata": getattr(t_node, "metadata", {}) or {},
-    "parent": getattr(t_node, "parent", None),
-    "children": getattr(t_node, "children", []) or [],
-} if t_node else {}
-
-                    parent_id = t_node.parent_id if t_node else None
-                    children_ids = [
-                        nid for nid, n in TOPOLOGY.items()
-                        if getattr(n, "parent_id", None) == cand["id"]
-                    ]
-                    topology_context = {"node": t_node_dict, "parent_id": parent_id, "children_ids": children_ids}
+                    topology_context = _build_topology_context(cand["id"], topology_data.TOPOLOGY_VERSION)
 
                     # キャッシュキーを生成
                     cache_key_analyst = "|".join([
                         "analyst",  # Analyst専用キー
                         selected_scenario,
                         str(cand.get("id")),
-                        _hash_text(json.dumps(topology_context, ensure_ascii=False, sort_keys=True)),
+                        _topology_context_digest(cand["id"], topology_data.TOPOLOGY_VERSION),
                         _hash_text(target_conf or ""),
                         _hash_text(verification_context or ""),
                     ])
 
-                    if "report_cache" not in st.session_state:
-                        st.session_state.report_cache = {}
-
-                    if cache_key_analyst in st.session_state.report_cache:
-                        full_text = st.session_state.report_cache[cache_key_analyst]
+                    cached_report = _report_cache_get(cache_key_analyst)
+                    if cached_report is not None:
+                        full_text = cached_report
                         report_container.markdown(full_text)
                     else:
                         # ★パフォーマンス改善: ストリーミング対応 + エラーハンドリング強化
                         try:
                             report_container.write("🤖 AI 分析中...")
                             placeholder = report_container.empty()
+                            stream_buf = _StreamBuffer(placeholder)
                             full_text = ""
                             error_occurred = False
                             
@@ -730,24 +1194,24 @@ with col_chat:
                                     max_retries=2,  # リトライ回数
                                     backoff=3       # リトライ間隔
                                 ):
-                                    full_text += chunk
-                                    placeholder.markdown(full_text)  # 段階的に更新
-                            except google_exceptions.ServiceUnavailable:
+                                    stream_buf.append(chunk)
+                                full_text = stream_buf.flush()
+                            except Exception as e:
+                                if not _is_api_error(e, _API_BUSY_ERRORS):
+                                    raise
                                 error_occurred = True
-                                full_text += "\n\n⚠️ **API が混雑しています。生成済みレポートを表示します。**"
+                                full_text = stream_buf.text() + "\n\n⚠️ **API が混雑しています。生成済みレポートを表示します。**"
                                 placeholder.markdown(full_text)
                             
-                            if not full_text or full_text.startswith("Error"):
+                            failed = not full_text or full_text.startswith("Error")
+                            if failed:
                                 full_text = f"⚠️ 分析レポート生成に失敗しました: {full_text}"
                                 placeholder.markdown(full_text)
                             
-                            # 部分的でもキャッシュに保存
-                            st.session_state.report_cache[cache_key_analyst] = full_text
-                        except google_exceptions.ServiceUnavailable:
-                            full_text = "⚠️ 現在、AIモデルが混雑しています (503 Error)。時間を置いて再度お試しください。"
-                            report_container.markdown(full_text)
+                            # 部分的でもキャッシュに保存（完全な応答のみディスクにも永続化）
+                            _report_cache_set(cache_key_analyst, full_text, persist=not (failed or error_occurred))
                         except Exception as e:
-                            full_text = f"⚠️ 分析レポート生成に失敗しました: {type(e).__name__}: {e}"
+                            full_text = _friendly_ai_error_message(e, "分析レポート生成")
                             report_container.markdown(full_text)
 
                     st.session_state.generated_report = full_text
@@ -755,9 +1219,7 @@ with col_chat:
             # 既存レポートをスクロール可能なコンテナで表示
             with st.container(height=400, border=True):
                 st.markdown(st.session_state.generated_report)
-            if st.button("🔄 レポート再作成"):
-                st.session_state.generated_report = None
-                st.rerun()
+            st.button("🔄 レポート再作成", on_click=_on_regenerate_report)
 
     # --- B. 自動修復 & チャット ---
     st.markdown("---")
@@ -790,14 +1252,16 @@ with col_chat:
                          _hash_text(st.session_state.generated_report or ""),
                      ])
                      
-                     if cache_key_remediation in st.session_state.report_cache:
-                         remediation_text = st.session_state.report_cache[cache_key_remediation]
+                     cached_plan = _report_cache_get(cache_key_remediation)
+                     if cached_plan is not None:
+                         remediation_text = cached_plan
                          remediation_container.markdown(remediation_text)
                      else:
                          try:
                              # ★パフォーマンス改善: ストリーミング対応 + エラーハンドリング強化
                              remediation_container.write("🤖 復旧プラン生成中...")
                              placeholder = remediation_container.empty()
+                             stream_buf = _StreamBuffer(placeholder)
                              remediation_text = ""
                              error_occurred = False
                              
@@ -811,24 +1275,24 @@ with col_chat:
                                      max_retries=2,  # リトライ回数
                                      backoff=3       # リトライ間隔
                                  ):
-                                     remediation_text += chunk
-                                     placeholder.markdown(remediation_text)  # 段階的に更新
-                             except google_exceptions.ServiceUnavailable:
+                                     stream_buf.append(chunk)
+                                 remediation_text = stream_buf.flush()
+                             except Exception as e:
+                                 if not _is_api_error(e, _API_BUSY_ERRORS):
+                                     raise
                                  error_occurred = True
-                                 remediation_text += "\n\n⚠️ **API が混雑しています。生成済みプランを表示します。**"
+                                 remediation_text = stream_buf.text() + "\n\n⚠️ **API が混雑しています。生成済みプランを表示します。**"
                                  placeholder.markdown(remediation_text)
                              
-                             if not remediation_text or remediation_text.startswith("Error"):
+                             failed = not remediation_text or remediation_text.startswith("Error")
+                             if failed:
                                  remediation_text = f"⚠️ 復旧プラン生成に失敗しました: {remediation_text}"
                                  placeholder.markdown(remediation_text)
                              
-                             # 部分的でもキャッシュに保存
-                             st.session_state.report_cache[cache_key_remediation] = remediation_text
-                         except google_exceptions.ServiceUnavailable:
-                             remediation_text = "⚠️ 現在、AIモデルが混雑しています (503 Error)。時間を置いて再度お試しください。"
-                             remediation_container.markdown(remediation_text)
+                             # 部分的でもキャッシュに保存（完全な応答のみディスクにも永続化）
+                             _report_cache_set(cache_key_remediation, remediation_text, persist=not (failed or error_occurred))
                          except Exception as e:
-                             remediation_text = f"⚠️ 復旧プラン生成に失敗しました: {type(e).__name__}: {e}"
+                             remediation_text = _friendly_ai_error_message(e, "復旧プラン生成")
                              remediation_container.markdown(remediation_text)
                      
                      st.session_state.remediation_plan = remediation_text
@@ -868,11 +1332,12 @@ with col_chat:
                             all_success = True
                             remediation_summary = []
                             
-                            for step_name in ["Backup", "Apply", "Verify"]:
+                            for step_name in REMEDIATION_STEPS:
                                 result = results.get(step_name)
                                 if result:
-                                    st.write(str(result))
-                                    remediation_summary.append(str(result))
+                                    line = str(result)  # 表示と検証ログで同じ文字列を共有
+                                    st.write(line)
+                                    remediation_summary.append(line)
                                     if result.status != "success":
                                         all_success = False
                             
@@ -892,16 +1357,13 @@ with col_chat:
                             st.success("Remediation Process Finished.")
 
             with col_exec2:
-                 if st.button("キャンセル"):
-                    del st.session_state.remediation_plan
-                    st.session_state.verification_log = None
-                    st.rerun()
+                 st.button("キャンセル", on_click=_on_cancel_remediation)
             
             if st.session_state.get("verification_log"):
                 st.markdown("#### 🔎 Post-Fix Verification Logs")
                 st.code(st.session_state.verification_log, language="text")
                 
-                is_success = "up" in st.session_state.verification_log.lower() or "ok" in st.session_state.verification_log.lower()
+                is_success = _SUCCESS_RE.search(st.session_state.verification_log) is not None
                 
                 if is_success:
                     # 復旧成功フラグ（デモ用）。次回の「診断実行」で成功側の疑似ログを返します。
@@ -919,12 +1381,7 @@ with col_chat:
                 else:
                     st.warning("⚠️ Verification indicates potential issues. Please check manually.")
 
-                if st.button("デモを終了してリセット"):
-                    del st.session_state.remediation_plan
-                    st.session_state.verification_log = None
-                    st.session_state.current_scenario = "正常稼働"
-                    st.session_state.balloons_shown = False  # バルーンフラグもリセット
-                    st.rerun()
+                st.button("デモを終了してリセット", on_click=_on_reset_demo)
     else:
         if selected_incident_candidate:
             device_id = selected_incident_candidate.get('id', '')
@@ -959,7 +1416,7 @@ with col_chat:
             _chat_target_id = ""
         if not _chat_target_id:
             _chat_target_id = target_device_id if 'target_device_id' in globals() else ""
-        _chat_ci = _build_ci_context_for_chat(_chat_target_id) if _chat_target_id else {}
+        _chat_ci = _get_ci_context_for_chat(_chat_target_id) if _chat_target_id else {}
         if _chat_ci:
             _vendor = _chat_ci.get("vendor", "") or "Unknown"
             _os = _chat_ci.get("os", "") or "Unknown"
@@ -986,9 +1443,7 @@ with col_chat:
             st.code(st.session_state.chat_quick_text)
 
         if st.session_state.chat_session is None and api_key:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel("gemma-3-12b-it")
-            st.session_state.chat_session = model.start_chat(history=[])
+            st.session_state.chat_session = _get_chat_model(api_key).start_chat(history=[])
 
         # タブでレイアウトを整理
         tab1, tab2 = st.tabs(["💬 会話", "📝 履歴"])
@@ -1015,9 +1470,7 @@ with col_chat:
             with col2:
                 send_button = st.button("送信", type="primary", use_container_width=True)
             with col3:
-                if st.button("クリア"):
-                    st.session_state.messages = []
-                    st.rerun()
+                st.button("クリア", on_click=_on_clear_chat)
             
             # 送信処理
             if send_button and prompt:
@@ -1036,12 +1489,12 @@ with col_chat:
                             target_id = target_device_id
                         except Exception:
                             target_id = ""
-                    ci = _build_ci_context_for_chat(target_id) if target_id else {}
+                    ci_json = _get_ci_context_json_for_chat(target_id)
                     ci_prompt = f"""あなたはネットワーク運用（NOC/SRE）の実務者です。
 次の CI 情報と Config 抜粋を必ず参照して、具体的に回答してください。一般論だけで終わらせないでください。
 
 【CI (JSON)】
-{json.dumps(ci, ensure_ascii=False, indent=2)}
+{ci_json}
 
 【ユーザーの質問】
 {prompt}
@@ -1052,36 +1505,34 @@ with col_chat:
 - 不明な前提は推測せず「CIに無いので確認が必要」と明記する
 """
                     
-                    with st.spinner("AI が回答を生成中..."):
-                        try:
-                            response = generate_content_with_retry(st.session_state.chat_session.model, ci_prompt, stream=False)
-                            if response:
-                                full_response = response.text if hasattr(response, "text") else str(response)
-                                if not full_response.strip():
-                                    full_response = "AI応答が空でした（CIは渡しましたが出力が生成されませんでした）。"
-                                st.session_state.messages.append({"role": "assistant", "content": full_response})
-                            else:
-                                st.error("AIからの応答がありませんでした。")
-                        except Exception as e:
-                            st.error(f"エラーが発生しました: {e}")
+                    # ★ ストリーミングで受信し、表示更新は一定間隔ごとにまとめて行う
+                    res_placeholder = st.empty()
+                    stream_buf = _StreamBuffer(res_placeholder)
+                    try:
+                        with st.spinner("AI が回答を生成中..."):
+                            for piece in cached_generate(st.session_state.chat_session.model, ci_prompt, stream=True):
+                                stream_buf.append(piece)
+                        full_response = stream_buf.text()
+                        if not full_response.strip():
+                            full_response = "AI応答が空でした（CIは渡しましたが出力が生成されませんでした）。"
+                        st.session_state.messages.append({"role": "assistant", "content": full_response})
+                    except Exception as e:
+                        st.error(f"エラーが発生しました: {e}")
                     st.rerun()
         
         with tab2:
             # スクロール可能な履歴表示
             if st.session_state.messages:
+                messages = st.session_state.messages
+                hidden = max(0, len(messages) - CHAT_HISTORY_VISIBLE_TURNS)
+                if hidden and st.toggle(f"古いメッセージも表示 ({hidden}件)", key="chat_show_all_history"):
+                    hidden = 0
                 history_container = st.container(height=400)
                 with history_container:
-                    for i, msg in enumerate(st.session_state.messages):
+                    for i, msg in enumerate(itertools.islice(messages, hidden, None), start=hidden):
                         icon = "🤖" if msg["role"] == "assistant" else "👤"
                         with st.container(border=True):
                             st.markdown(f"{icon} **{msg['role'].upper()}** (メッセージ {i+1})")
                             st.markdown(msg["content"])
             else:
                 st.info("会話履歴はまだありません。")
-
-# ベイズ更新トリガー (診断後)
-if st.session_state.trigger_analysis and st.session_state.live_result:
-    if st.session_state.verification_result:
-        pass
-    st.session_state.trigger_analysis = False
-    st.rerun()
@@ -6,7 +6,7 @@ Google Antigravity AIOps Agent - Data Module (Optimized Final)
 import json
 import os
 import logging
-from typing import Dict, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass, field
 
 # =====================================================
@@ -97,7 +97,7 @@ DEFAULT_RAW_DATA = {
 # トポロジー読み込み関数
 # =====================================================
 def load_topology_from_json(filename: str = TopologyConstants.DEFAULT_TOPOLOGY_FILE) -> Dict[str, NetworkNode]:
-    """JSONファイルからトポロジーを読み込み"""
+    """JSONファイルからトポロジーを読み込み（読み込むたびに TOPOLOGY_VERSION をインクリメント）"""
     topology = {}
     raw_data = {}
 
@@ -138,6 +138,7 @@ def load_topology_from_json(filename: str = TopologyConstants.DEFAULT_TOPOLOGY_F
     if topology:
         validate_topology(topology)
 
+    mark_topology_changed()
     return topology
 
 # =====================================================
@@ -176,7 +177,81 @@ def _has_circular_reference(node: NetworkNode, topology: Dict[str, NetworkNode],
         return _has_circular_reference(parent, topology, visited)
     return False
 
+# =====================================================
+# トポロジー索引（線形走査の置き換え）
+# =====================================================
+@dataclass
+class TopologyIndex:
+    """トポロジー検索用の索引（トポロジー1つにつき一度だけ構築）"""
+    node_ids: List[str]
+    by_type: Dict[str, List[str]]
+    by_layer: Dict[int, List[str]]
+    by_type_layer: Dict[Tuple[str, int], List[str]]
+    children: Dict[str, List[str]]
+    search_blobs: Dict[str, str]
+    redundancy_partners: Dict[str, List[str]]
+    redundancy_peers: Dict[str, Tuple[str, ...]]
+
+def build_topology_index(topology: Dict[str, NetworkNode]) -> TopologyIndex:
+    """type / layer / 親 / 冗長グループ別のID一覧と、キーワード検索対象の文字列を構築（挿入順を保持）"""
+    by_type: Dict[str, List[str]] = {}
+    by_layer: Dict[int, List[str]] = {}
+    by_type_layer: Dict[Tuple[str, int], List[str]] = {}
+    children: Dict[str, List[str]] = {}
+    search_blobs: Dict[str, str] = {}
+    redundancy_partners: Dict[str, List[str]] = {}
+    for node_id, node in topology.items():
+        by_type.setdefault(node.type, []).append(node_id)
+        by_layer.setdefault(node.layer, []).append(node_id)
+        by_type_layer.setdefault((node.type, node.layer), []).append(node_id)
+        if node.parent_id:
+            children.setdefault(node.parent_id, []).append(node_id)
+        # ★ node_id + 文字列メタデータを連結・casefold した検索用文字列（部分一致1回で判定）
+        search_blobs[node_id] = "\n".join(
+            [node_id, *(v for v in node.metadata.values() if isinstance(v, str))]
+        ).casefold()
+        if node.redundancy_group:
+            redundancy_partners.setdefault(node.redundancy_group, []).append(node_id)
+    # ノードID -> 同一冗長グループの相方（自身を除く）。描画時のフィルタを不要にする
+    redundancy_peers: Dict[str, Tuple[str, ...]] = {
+        node_id: tuple(pid for pid in members if pid != node_id)
+        for members in redundancy_partners.values()
+        for node_id in members
+    }
+    return TopologyIndex(
+        node_ids=list(topology.keys()),
+        by_type=by_type,
+        by_layer=by_layer,
+        by_type_layer=by_type_layer,
+        children=children,
+        search_blobs=search_blobs,
+        redundancy_partners=redundancy_partners,
+        redundancy_peers=redundancy_peers,
+    )
+
+# (構築時の TOPOLOGY_VERSION, 対象トポロジー, 索引) の1件のみ保持。
+# トポロジー本体を強参照で持つため id の再利用で別トポロジーに当たることはない
+_topology_index_cache: Optional[Tuple[int, Dict[str, NetworkNode], TopologyIndex]] = None
+
+def mark_topology_changed() -> None:
+    """トポロジーを読み込み・変更したことを通知（TOPOLOGY_VERSION を進め、索引などの派生キャッシュを無効化）"""
+    global TOPOLOGY_VERSION
+    TOPOLOGY_VERSION += 1
+
+def get_topology_index(topology: Dict[str, NetworkNode]) -> TopologyIndex:
+    """索引を取得（同一トポロジー・同一 TOPOLOGY_VERSION の間は再利用。
+    ノードを直接書き換えた場合は mark_topology_changed() を呼ぶ）"""
+    global _topology_index_cache
+    cached = _topology_index_cache
+    if cached and cached[0] == TOPOLOGY_VERSION and cached[1] is topology:
+        return cached[2]
+    index = build_topology_index(topology)
+    _topology_index_cache = (TOPOLOGY_VERSION, topology, index)
+    return index
+
 # =====================================================
 # グローバル変数
 # =====================================================
+# load_topology_from_json のたびに進む世代番号（派生キャッシュの無効化用。参照側は data.TOPOLOGY_VERSION を呼び出し時に読む）
+TOPOLOGY_VERSION = 0
 TOPOLOGY = load_topology_from_json()
@@ -1,10 +1,25 @@
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
 import json
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from enum import Enum
 from typing import List, Dict, Any, Optional
 
-import google.generativeai as genai
+try:
+    import orjson  # 任意依存（未導入なら標準 json にフォールバック）
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl  # POSIX のみ（無い環境ではチェックポイントの詰め直しを行わない）
+except ImportError:
+    fcntl = None
 
 # ==========================================================
 # AIOps health status
@@ -15,6 +30,155 @@ class HealthStatus(Enum):
     CRITICAL = "RED"
 
 
+# HealthStatus -> (prob, tier)。未知の値は NORMAL 扱い
+_STATUS_TO_PROB_TIER = {
+    HealthStatus.CRITICAL: (0.9, 1),
+    HealthStatus.WARNING: (0.7, 2),
+    HealthStatus.NORMAL: (0.3, 3),
+}
+# LLM 応答の status 文字列（大文字化済み）-> HealthStatus。未知の値は CRITICAL 扱い
+_STATUS_STR_TO_HEALTH = {
+    "GREEN": HealthStatus.NORMAL,
+    "NORMAL": HealthStatus.NORMAL,
+    "YELLOW": HealthStatus.WARNING,
+    "WARNING": HealthStatus.WARNING,
+}
+
+
+# アラーム無し時の解析結果（analyze の空入力時に返す固定値）
+NO_ALERT_RESULT: Dict[str, Any] = {
+    "id": "SYSTEM",
+    "label": "No alerts detected",
+    "prob": 0.0,
+    "type": "Normal",
+    "tier": 0,
+    "reason": "No active alerts detected."
+}
+
+# API 未設定時に LLM 判定の代わりに返す結果
+NO_API_ANALYSIS: Dict[str, Any] = {
+    "status": HealthStatus.WARNING,
+    "reason": "API key not configured. Manual analysis required.",
+    "impact_type": "UNKNOWN",
+}
+
+
+def _dumps_record(rec: Dict[str, Any]) -> str:
+    """チェックポイント (JSONL) 1 行分の直列化（プロンプト整形とは独立した固定フォーマット）"""
+    return json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+
+
+def _context_digest(metadata: Dict[str, Any], config: str) -> str:
+    """プロンプトに載るデバイス文脈（metadata / サニタイズ済み Config）のダイジェスト"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(_dumps_for_prompt(metadata).encode("utf-8"))
+    h.update(b"\x1e" + config.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _dev_cache_key(device_id: str, alerts: List[str], context_digest: str) -> str:
+    """デバイス単位の LLM 判定キャッシュのキー（アラートは順不同で同一視。
+    デバイス文脈のダイジェストも含め、Config 変更時は再判定する）"""
+    payload = device_id + "|" + "\x1f".join(sorted(alerts)) + "|" + context_digest
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# ==========================================================
+# Sanitization patterns（モジュール読み込み時に一度だけコンパイル）
+# ==========================================================
+_RE_ENCPW = re.compile(r'(encrypted-password\s+)"[^"]+"')
+_RE_PWSEC = re.compile(r"(password|secret)\s+(\d)\s+\S+")
+_RE_USER = re.compile(r"(username\s+\S+\s+secret)\s+\d\s+\S+")
+_RE_SNMP = re.compile(r"(snmp-server community)\s+\S+")
+
+
+@functools.lru_cache(maxsize=4096)
+def _sanitize_cached(text: str) -> str:
+    """機密値のマスク（同一のアラート文・Config は正規表現を再実行しない）"""
+    text = _RE_ENCPW.sub(r'\1"********"', text)
+    text = _RE_PWSEC.sub(r"\1 \2 ********", text)
+    text = _RE_USER.sub(r"\1 5 ********", text)
+    text = _RE_SNMP.sub(r"\1 ********", text)
+    return text
+
+
+@functools.lru_cache(maxsize=256)
+def _read_config_cached(path: str, mtime_ns: int) -> str:
+    """デバイス Config の読み込み（mtime が変われば別キーとして再読込。読込失敗は例外で返しキャッシュしない）"""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+# Connection Lost 系メッセージ判定（4 つの部分一致を 1 本の正規表現に。小文字化済みテキストに適用）
+_CONN_LOSS_RE = re.compile(r"connection lost|link down|port down|unreachable")
+
+
+# ==========================================================
+# Local rule keywords（全キーワードを 1 本の正規表現で 1 回走査し、ビットマスクで判定）
+# ==========================================================
+_KW_POWER_SUPPLY = 1 << 0
+_KW_FAILED = 1 << 1
+_KW_FAIL = 1 << 2
+_KW_DUAL = 1 << 3
+_KW_PSU = 1 << 4
+_KW_FAN = 1 << 5
+_KW_HIGH_TEMP = 1 << 6
+_KW_HIGH = 1 << 7
+_KW_OVERHEAT = 1 << 8
+_KW_THERMAL = 1 << 9
+_KW_MEMORY = 1 << 10
+_KW_LEAK = 1 << 11
+_KW_OUT_OF_MEMORY = 1 << 12
+_KW_OOM = 1 << 13
+_KW_KILLED_PROCESS = 1 << 14
+_KW_KERNEL_PANIC = 1 << 15
+
+# 同じ位置から始まるキーワードは長い方を先に置き、短い方のビットも併せて立てる（failed -> fail 等）
+_LOCAL_RULE_KEYWORDS: Dict[str, int] = {
+    "power supply": _KW_POWER_SUPPLY,
+    "failed": _KW_FAILED | _KW_FAIL,
+    "fail": _KW_FAIL,
+    "dual": _KW_DUAL,
+    "psu": _KW_PSU,
+    "fan": _KW_FAN,
+    "high temperature": _KW_HIGH_TEMP | _KW_HIGH,
+    "high": _KW_HIGH,
+    "overheat": _KW_OVERHEAT,
+    "thermal": _KW_THERMAL,
+    "memory": _KW_MEMORY,
+    "leak": _KW_LEAK,
+    "out of memory": _KW_OUT_OF_MEMORY,
+    "oom": _KW_OOM,
+    "killed process": _KW_KILLED_PROCESS,
+    "kernel panic": _KW_KERNEL_PANIC,
+}
+# 先読みで各位置のキーワードを拾う（重なり合う出現も取りこぼさない）
+_LOCAL_RULE_RE = re.compile("(?=(" + "|".join(map(re.escape, _LOCAL_RULE_KEYWORDS)) + "))")
+
+_KW_OVERHEAT_HINT = _KW_HIGH_TEMP | _KW_OVERHEAT | _KW_THERMAL
+_KW_OOM_HINT = _KW_OUT_OF_MEMORY | _KW_OOM | _KW_KILLED_PROCESS | _KW_KERNEL_PANIC
+
+
+def _sort_by_prob_desc(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """prob 降順の安定ソート。prob は数種類の離散値なので値ごとのバケットに振り分けて連結する"""
+    buckets: Dict[float, List[Dict[str, Any]]] = {}
+    for r in results:
+        buckets.setdefault(r["prob"], []).append(r)
+    return [r for p in sorted(buckets, reverse=True) for r in buckets[p]]
+
+
+def _keyword_mask(text_lower: str) -> int:
+    """小文字化済みテキストに含まれるローカルルール用キーワードのビットマスク"""
+    mask = 0
+    for m in _LOCAL_RULE_RE.finditer(text_lower):
+        mask |= _LOCAL_RULE_KEYWORDS[m.group(1)]
+    return mask
+
+
+# 停止系（赤）の判定語。大文字小文字は区別する（"Power Supply: Dual Loss" は "Dual Loss" に包含）
+_CRITICAL_RE = re.compile(r"Dual Loss|Device Down|Thermal Shutdown")
+
+
 class LogicalRCA:
     """
     LogicalRCA (v5):
@@ -27,6 +191,19 @@ class LogicalRCA:
     SILENT_MIN_CHILDREN = 2
     SILENT_RATIO = 0.5
 
+    # LLM 判定を 1 リクエストにまとめるデバイス数の上限
+    MAX_BATCH_SIZE = 8
+    # 同時に投げるバッチ数の上限（レート制限を超えない範囲で I/O 待ちを重ねる）
+    MAX_PARALLEL_BATCHES = 4
+    # デバイス単位の LLM 判定キャッシュの上限件数（LRU）
+    LLM_RESULT_CACHE_SIZE = 1024
+    # LLM 判定結果のチェックポイント（追記型 JSONL。config_dir ごとに別ファイル。読み込み時は無効行を読み飛ばすだけ）
+    LLM_CHECKPOINT_PATH = ".llm_checkpoint.jsonl"
+    LLM_CHECKPOINT_TTL = 24 * 3600  # 秒
+    # 無効行がこの件数以上かつ全体のこの割合を超えたら、ファイルロックを取って詰め直す
+    LLM_CHECKPOINT_COMPACT_MIN_LINES = 256
+    LLM_CHECKPOINT_COMPACT_RATIO = 0.5
+
     def __init__(self, topology, config_dir: str = "./configs"):
         """
         :param topology: トポロジー辞書（device_id -> dict or NetworkNode） または JSONファイルパス(str)
@@ -42,6 +219,14 @@ class LogicalRCA:
         self.config_dir = config_dir
         self.model = None
         self._api_configured = False
+        self._config_error: Optional[str] = None
+        # (device_id, アラート集合) -> LLM 判定結果。バッチ並列実行に備えてロックで保護
+        self._llm_result_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._llm_result_lock = threading.Lock()
+        # ★ 別トポロジー/別 config_dir のインスタンスと同じファイルを奪い合わないよう、config_dir でファイルを分ける
+        scope = hashlib.blake2b(os.path.abspath(config_dir).encode("utf-8"), digest_size=6).hexdigest()
+        base, ext = os.path.splitext(self.LLM_CHECKPOINT_PATH)
+        self._ckpt_path = f"{base}.{scope}{ext}"
 
         # parent -> [children...]
         self.children_map: Dict[str, List[str]] = {}
@@ -59,22 +244,38 @@ class LogicalRCA:
             if p:
                 self.children_map.setdefault(p, []).append(dev_id)
 
+        # child -> parent / parent -> children_map 内の順位（サイレント推定をアラーム側から引くため）
+        self._parent_of: Dict[str, str] = {
+            c: p for p, children in self.children_map.items() for c in children
+        }
+        self._parent_rank: Dict[str, int] = {p: i for i, p in enumerate(self.children_map)}
+
+        # ★ dict / NetworkNode の判別は構築時に一度だけ行い、判定時はフラットな辞書を引くだけにする
+        self._index_topology()
+
+        # ★ 前回プロセスまでの LLM 判定をチェックポイントから復元（落ちても課金済みの判定をやり直さない）
+        self._load_checkpoint()
+
+        # ★ API キーがあれば構築時に一度だけ設定（判定時は self._api_configured を見るだけ。失敗時は判定時に再試行）
+        if os.environ.get("GOOGLE_API_KEY"):
+            self._ensure_api_configured()
+
     # ----------------------------
     # Topology helpers
     # ----------------------------
     def _get_device_info(self, device_id: str) -> Any:
         return self.topology.get(device_id, {})
 
-    def _get_parent_id(self, device_id: str) -> Optional[str]:
-        info = self._get_device_info(device_id)
+    @staticmethod
+    def _parent_id_from_info(info: Any) -> Optional[str]:
         if isinstance(info, dict):
             return info.get("parent_id")
         if hasattr(info, "parent_id"):
             return getattr(info, "parent_id")
         return None
 
-    def _get_metadata(self, device_id: str) -> Dict[str, Any]:
-        info = self._get_device_info(device_id)
+    @staticmethod
+    def _metadata_from_info(info: Any) -> Dict[str, Any]:
         if isinstance(info, dict):
             md = info.get("metadata", {})
             return md if isinstance(md, dict) else {}
@@ -90,22 +291,42 @@ class LogicalRCA:
                 return {}
         return {}
 
-    def _get_psu_count(self, device_id: str, default: int = 1) -> int:
+    @staticmethod
+    def _psu_count_from_metadata(md: Dict[str, Any]) -> Optional[int]:
         """
-        topology の metadata.hw_inventory.psu_count を優先参照。
-        無い場合は metadata.redundancy_type == 'PSU' なら 2 を仮定。
+        metadata.hw_inventory.psu_count を優先参照。
+        無い場合は metadata.redundancy_type == 'PSU' なら 2 を仮定。判定できなければ None。
         """
-        md = self._get_metadata(device_id)
-        if isinstance(md, dict):
-            hw = md.get("hw_inventory", {})
-            if isinstance(hw, dict) and "psu_count" in hw:
-                try:
-                    return int(hw.get("psu_count"))
-                except Exception:
-                    pass
-            if str(md.get("redundancy_type", "")).upper() == "PSU":
-                return 2
-        return default
+        hw = md.get("hw_inventory", {})
+        if isinstance(hw, dict) and "psu_count" in hw:
+            try:
+                return int(hw.get("psu_count"))
+            except Exception:
+                pass
+        if str(md.get("redundancy_type", "")).upper() == "PSU":
+            return 2
+        return None
+
+    def _index_topology(self) -> None:
+        """device_id -> parent_id / metadata / psu_count を事前計算"""
+        self._parent_id: Dict[str, Optional[str]] = {}
+        self._metadata: Dict[str, Dict[str, Any]] = {}
+        self._psu_count: Dict[str, Optional[int]] = {}
+        for dev_id, info in self.topology.items():
+            md = self._metadata_from_info(info)
+            self._parent_id[dev_id] = self._parent_id_from_info(info)
+            self._metadata[dev_id] = md
+            self._psu_count[dev_id] = self._psu_count_from_metadata(md)
+
+    def _get_parent_id(self, device_id: str) -> Optional[str]:
+        return self._parent_id.get(device_id)
+
+    def _get_metadata(self, device_id: str) -> Dict[str, Any]:
+        return self._metadata.get(device_id, {})
+
+    def _get_psu_count(self, device_id: str, default: int = 1) -> int:
+        psu_count = self._psu_count.get(device_id)
+        return default if psu_count is None else psu_count
 
     # ----------------------------
     # LLM init
@@ -117,11 +338,13 @@ class LogicalRCA:
         if not api_key:
             return False
         try:
-            genai.configure(api_key=api_key)
+            import google.generativeai as genai  # 遅延インポート（API 利用時のみ）
+            genai.configure(api_key=api_key, transport="grpc")  # HTTP/2 常駐チャネルを再利用
             self.model = genai.GenerativeModel("gemini-1.5-flash")
             self._api_configured = True
             return True
         except Exception as e:
+            self._config_error = str(e)
             print(f"[!] API Configuration Error: {e}")
             return False
 
@@ -134,58 +357,176 @@ class LogicalRCA:
         with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
 
+    def _device_context(self, device_id: str) -> tuple:
+        """プロンプトに載せるデバイス文脈 (metadata, サニタイズ済み Config)"""
+        return self._get_metadata(device_id), self._sanitize_text(self._read_config(device_id))
+
     def _read_config(self, device_id: str) -> str:
         config_path = os.path.join(self.config_dir, f"{device_id}.txt")
-        if os.path.exists(config_path):
+        try:
+            mtime_ns = os.stat(config_path).st_mtime_ns
+        except OSError:
+            return "Config file not found."  # 未配置はキャッシュしない（後から置かれたファイルを拾う）
+        try:
+            return _read_config_cached(config_path, mtime_ns)
+        except Exception as e:
+            return f"Error reading config: {str(e)}"
+
+    @contextlib.contextmanager
+    def _checkpoint_lock(self):
+        """チェックポイントのプロセス間ロック（fcntl が無い環境では False を返してロックなしで進む）"""
+        if fcntl is None:
+            yield False
+            return
+        with open(self._ckpt_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _parse_checkpoint_line(self, line: str, now: float, digests: Dict[str, str]):
+        """
+        1 行を判定して (key, rec, analysis) を返す。無効行（期限切れ・Config 変更済み・破損）は None。
+        このインスタンスのトポロジーに無いデバイスの行は analysis=None で残す（他インスタンスの判定を消さない）
+        """
+        try:
+            rec = json.loads(line)
+            key, device_id, r = rec["k"], rec["d"], rec["r"]
+            if now - float(rec["ts"]) > self.LLM_CHECKPOINT_TTL:
+                return None
+            if device_id not in self.topology:
+                return key, rec, None
+            if device_id not in digests:
+                digests[device_id] = _context_digest(*self._device_context(device_id))
+            if rec["c"] != digests[device_id]:
+                return None  # 記録後に Config / metadata が変わった判定
+            analysis = {"status": HealthStatus(r["status"]), "reason": r["reason"], "impact_type": r["impact_type"]}
+        except (ValueError, KeyError, TypeError):
+            return None  # 書き込み途中で落ちた末尾行など
+        return key, rec, analysis
+
+    def _load_checkpoint(self) -> None:
+        """有効な判定だけをキャッシュへ復元する（ファイルは書き換えない。無効行が溜まった時だけ詰め直す）"""
+        if not os.path.exists(self._ckpt_path):
+            return
+        now = time.time()
+        digests: Dict[str, str] = {}
+        records: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        total = live = 0
+        try:
+            with open(self._ckpt_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    total += 1
+                    parsed = self._parse_checkpoint_line(line, now, digests)
+                    if parsed is None:
+                        continue
+                    key, _, analysis = parsed
+                    if key not in records:
+                        live += 1  # 同じキーの古い行は上書きされる（無効行として数える）
+                    if analysis is not None:
+                        records[key] = analysis
+                        records.move_to_end(key)
+        except OSError as e:
+            print(f"[!] Checkpoint Load Error: {e}")
+            return
+        while len(records) > self.LLM_RESULT_CACHE_SIZE:
+            records.popitem(last=False)
+        self._llm_result_cache.update(records)
+        stale = total - live
+        if stale >= self.LLM_CHECKPOINT_COMPACT_MIN_LINES and stale > total * self.LLM_CHECKPOINT_COMPACT_RATIO:
+            self._compact_checkpoint()
+
+    def _compact_checkpoint(self) -> None:
+        """ロック下でファイルを読み直し、有効行だけに詰め直す（他プロセスの追記を失わないよう追記側も同じロックを取る）"""
+        with self._checkpoint_lock() as locked:
+            if not locked:
+                return
+            now = time.time()
+            digests: Dict[str, str] = {}
+            records: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+            tmp_path = self._ckpt_path + ".tmp"
             try:
-                with open(config_path, "r", encoding="utf-8") as f:
-                    return f.read()
-            except Exception as e:
-                return f"Error reading config: {str(e)}"
-        return "Config file not found."
+                with open(self._ckpt_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        parsed = self._parse_checkpoint_line(line, now, digests)
+                        if parsed is not None:
+                            key, rec, _ = parsed
+                            records[key] = rec
+                            records.move_to_end(key)
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write("".join(_dumps_record(rec) + "\n" for rec in records.values()))
+                os.replace(tmp_path, self._ckpt_path)
+            except OSError as e:
+                print(f"[!] Checkpoint Write Error: {e}")
+
+    def _append_checkpoint(self, entries: List[tuple]) -> None:
+        """(cache_key, device_id, 文脈ダイジェスト, analysis) を 1 行 1 件で追記（呼び出し側で _llm_result_lock を保持）"""
+        if not entries:
+            return
+        now = time.time()
+        lines = "".join(
+            _dumps_record({
+                "k": key, "d": device_id, "c": digest, "ts": now,
+                "r": {"status": a["status"].value, "reason": a.get("reason", ""), "impact_type": a.get("impact_type", "UNKNOWN")},
+            }) + "\n"
+            for key, device_id, digest, a in entries
+        )
+        try:
+            with self._checkpoint_lock(), open(self._ckpt_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+        except OSError as e:
+            print(f"[!] Checkpoint Write Error: {e}")
 
     # ----------------------------
     # Sanitization
     # ----------------------------
     def _sanitize_text(self, text: str) -> str:
-        text = re.sub(r'(encrypted-password\s+)"[^"]+"', r'\1"********"', text)
-        text = re.sub(r"(password|secret)\s+(\d)\s+\S+", r"\1 \2 ********", text)
-        text = re.sub(r"(username\s+\S+\s+secret)\s+\d\s+\S+", r"\1 5 ********", text)
-        text = re.sub(r"(snmp-server community)\s+\S+", r"\1 ********", text)
-        return text
+        return _sanitize_cached(text)
 
     # ==========================================================
     # Silent failure inference
     # ==========================================================
-    def _is_connection_loss(self, msg: str) -> bool:
-        msg_l = msg.lower()
-        return (
-            "connection lost" in msg_l
-            or "link down" in msg_l
-            or "port down" in msg_l
-            or "unreachable" in msg_l
-        )
-
-    def _detect_silent_failures(self, msg_map: Dict[str, List[str]]) -> Dict[str, Dict[str, Any]]:
+    def _classify_devices(self, msg_map: Dict[str, List[str]]):
+        """デバイスごとのメッセージを1回だけ連結・小文字化し、(Connection Lost 系, unreachable) のデバイス集合を返す
+        （各キーワードは改行を含まないため、改行で連結してもメッセージを跨いだ誤一致は起きない）
+        """
+        conn_loss_set = set()
+        unreachable_set = set()
+        for dev, msgs in msg_map.items():
+            lower_concat = "\n".join(msgs).lower()
+            if _CONN_LOSS_RE.search(lower_concat):
+                conn_loss_set.add(dev)
+            if "unreachable" in lower_concat:
+                unreachable_set.add(dev)
+        return conn_loss_set, unreachable_set
+
+    def _detect_silent_failures(
+        self, msg_map: Dict[str, List[str]], conn_loss_set: Optional[set] = None
+    ) -> Dict[str, Dict[str, Any]]:
         """
         親自身にアラームが無いのに、配下の複数子が Connection Lost を出しているなら親を疑う。
+        conn_loss_set: 事前計算済みの Connection Lost デバイス集合（省略時はここで算出）
         """
         suspects: Dict[str, Dict[str, Any]] = {}
+        if conn_loss_set is None:
+            conn_loss_set = self._classify_devices(msg_map)[0]
 
-        for parent_id, children in self.children_map.items():
-            if not children:
+        # ★ 全親を走査せず、Connection Lost を出した子から親ごとに集計する（アラーム件数に比例）
+        affected_by_parent: Dict[str, set] = {}
+        for dev_id in msg_map:
+            if dev_id not in conn_loss_set:
                 continue
-            if parent_id in msg_map:
+            parent_id = self._parent_of.get(dev_id)
+            if parent_id is None or parent_id in msg_map:
                 continue
+            affected_by_parent.setdefault(parent_id, set()).add(dev_id)
 
-            affected = []
-            for c in children:
-                msgs = msg_map.get(c, [])
-                if any(self._is_connection_loss(m) for m in msgs):
-                    affected.append(c)
-
-            if not affected:
-                continue
+        # 出力順は従来どおり children_map の順（子も children_map 内の順）
+        for parent_id in sorted(affected_by_parent, key=self._parent_rank.__getitem__):
+            children = self.children_map[parent_id]
+            affected_set = affected_by_parent[parent_id]
+            affected = [c for c in children if c in affected_set]
 
             total = len(children)
             ratio = len(affected) / max(total, 1)
@@ -217,25 +558,22 @@ class LogicalRCA:
     # ==========================================================
     def analyze(self, alarms: List) -> List[Dict[str, Any]]:
         if not alarms:
-            return [{
-                "id": "SYSTEM",
-                "label": "No alerts detected",
-                "prob": 0.0,
-                "type": "Normal",
-                "tier": 0,
-                "reason": "No active alerts detected."
-            }]
+            return [dict(NO_ALERT_RESULT)]
 
         msg_map: Dict[str, List[str]] = {}
         for a in alarms:
             msg_map.setdefault(a.device_id, []).append(a.message)
 
+        # ★ Connection Lost / unreachable 判定はデバイス単位で1回だけ行い、以降は集合の所属判定のみ
+        conn_loss_set, unreachable_set = self._classify_devices(msg_map)
+
         # サイレント推定
-        silent_suspects = self._detect_silent_failures(msg_map)
+        silent_suspects = self._detect_silent_failures(msg_map, conn_loss_set)
 
-        # 親を分析対象に追加（疑似アラーム）
+        # 親を分析対象に追加（疑似アラーム。文言に "Connection Lost" を含むため集合にも加える）
         for parent_id, info in silent_suspects.items():
             msg_map.setdefault(parent_id, []).append("Silent Failure Suspected (Derived from child Connection Lost)")
+        conn_loss_set.update(silent_suspects)
 
         alarmed_ids = set(msg_map.keys())
 
@@ -248,15 +586,18 @@ class LogicalRCA:
             return bool(p and (p in silent_suspects))
 
         results: List[Dict[str, Any]] = []
+        # LLM 判定待ちのデバイス -> results 内の位置
+        deferred: Dict[str, int] = {}
 
         for device_id, messages in msg_map.items():
+            label = " / ".join(messages)
 
             # サイレント疑い配下の子は被疑（症状）扱い
-            if parent_is_silent_suspect(device_id) and any(self._is_connection_loss(m) for m in messages):
+            if parent_is_silent_suspect(device_id) and device_id in conn_loss_set:
                 p = self._get_parent_id(device_id)
                 results.append({
                     "id": device_id,
-                    "label": " / ".join(messages),
+                    "label": label,
                     "prob": 0.4,
                     "type": "Network/ConnectionLost",
                     "tier": 3,
@@ -265,11 +606,11 @@ class LogicalRCA:
                 continue
 
             # 通常のカスケード抑制
-            if any("unreachable" in m.lower() for m in messages) and parent_is_alarmed(device_id):
+            if device_id in unreachable_set and parent_is_alarmed(device_id):
                 p = self._get_parent_id(device_id)
                 results.append({
                     "id": device_id,
-                    "label": " / ".join(messages),
+                    "label": label,
                     "prob": 0.2,
                     "type": "Network/Unreachable",
                     "tier": 3,
@@ -282,7 +623,7 @@ class LogicalRCA:
                 info = silent_suspects[device_id]
                 results.append({
                     "id": device_id,
-                    "label": " / ".join(messages),
+                    "label": label,
                     "prob": 0.8,
                     "type": "Network/SilentFailure",
                     "tier": 1,
@@ -297,33 +638,57 @@ class LogicalRCA:
                 })
                 continue
 
-            analysis = self.analyze_redundancy_depth(device_id, messages)
+            analysis = self._apply_local_rules(device_id, messages)
+            if analysis is None:
+                # ローカルルールで判定できない機器は後段で LLM にまとめて問い合わせる
+                deferred[device_id] = len(results)
+                results.append({"id": device_id, "label": label})
+                continue
 
-            if analysis.get("impact_type") == "UNKNOWN" and "API key not configured" in analysis.get("reason", ""):
-                prob = 0.5
-                tier = 3
+            results.append(self._build_result(device_id, messages, analysis, label))
+
+        # ★ API が使えない場合はバッチ分割・キャッシュ照合・スレッド起動を一切せずに手動解析扱いで埋める
+        if deferred and not self._api_configured and not self._ensure_api_configured():
+            for device_id, idx in deferred.items():
+                results[idx] = self._build_result(device_id, msg_map[device_id], dict(NO_API_ANALYSIS), results[idx]["label"])
+            deferred = {}
+
+        # LLM 判定（MAX_BATCH_SIZE 台ずつ 1 リクエストにまとめ、複数バッチは並列に投げる）
+        if deferred:
+            pending = list(deferred.keys())
+            batches = [
+                {d: msg_map[d] for d in pending[i:i + self.MAX_BATCH_SIZE]}
+                for i in range(0, len(pending), self.MAX_BATCH_SIZE)
+            ]
+            if len(batches) == 1:
+                batch_results_list = [self._analyze_batch_with_llm(batches[0])]
             else:
-                if analysis["status"] == HealthStatus.CRITICAL:
-                    prob = 0.9
-                    tier = 1
-                elif analysis["status"] == HealthStatus.WARNING:
-                    prob = 0.7
-                    tier = 2
-                else:
-                    prob = 0.3
-                    tier = 3
-
-            results.append({
-                "id": device_id,
-                "label": " / ".join(messages),
-                "prob": prob,
-                "type": analysis.get("impact_type", "UNKNOWN"),
-                "tier": tier,
-                "reason": analysis.get("reason", "AI provided no reason")
-            })
+                workers = min(self.MAX_PARALLEL_BATCHES, len(batches))
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    batch_results_list = list(executor.map(self._analyze_batch_with_llm, batches))
+            for batch_results in batch_results_list:
+                for device_id, analysis in batch_results.items():
+                    idx = deferred[device_id]
+                    results[idx] = self._build_result(device_id, msg_map[device_id], analysis, results[idx]["label"])
+
+        return _sort_by_prob_desc(results)
+
+    def _build_result(
+        self, device_id: str, messages: List[str], analysis: Dict[str, Any], label: Optional[str] = None
+    ) -> Dict[str, Any]:
+        if analysis.get("impact_type") == "UNKNOWN" and "API key not configured" in analysis.get("reason", ""):
+            prob, tier = 0.5, 3
+        else:
+            prob, tier = _STATUS_TO_PROB_TIER.get(analysis["status"], (0.3, 3))
 
-        results.sort(key=lambda x: x["prob"], reverse=True)
-        return results
+        return {
+            "id": device_id,
+            "label": label if label is not None else " / ".join(messages),
+            "prob": prob,
+            "type": analysis.get("impact_type", "UNKNOWN"),
+            "tier": tier,
+            "reason": analysis.get("reason", "AI provided no reason")
+        }
 
     # ==========================================================
     # Core decision function
@@ -340,62 +705,158 @@ class LogicalRCA:
         # 将来、インベントリ＋過去の証跡が十分に利用できるようになったら、
         # この判断はAIに委譲すべきです。
         """
+        analysis = self._apply_local_rules(device_id, alerts)
+        if analysis is not None:
+            return analysis
+        return self._analyze_batch_with_llm({device_id: alerts})[device_id]
+
+    def _apply_local_rules(self, device_id: str, alerts: List[str]) -> Optional[Dict[str, Any]]:
+        """
+        ローカル安全ルールで判定する。判定できない場合は None（LLM 判定へ回す）。
+        """
         if not alerts:
             return {"status": HealthStatus.NORMAL, "reason": "No active alerts detected.", "impact_type": "NONE"}
 
         safe_alerts = [self._sanitize_text(a) for a in alerts]
         joined = " ".join(safe_alerts)
-        joined_lower = joined.lower()
+        kw = _keyword_mask(joined.lower())
 
         # 0) 停止系（赤）
-        if ("Power Supply: Dual Loss" in joined) or ("Dual Loss" in joined) or ("Device Down" in joined) or ("Thermal Shutdown" in joined):
+        if _CRITICAL_RE.search(joined):
             return {"status": HealthStatus.CRITICAL, "reason": "Device down / dual PSU loss / thermal shutdown detected (local safety rule).", "impact_type": "Hardware/Physical"}
 
         # 1) 電源片系（黄色/赤）
         psu_count = self._get_psu_count(device_id, default=1)
-        psu_single_fail = ("power supply" in joined_lower and "failed" in joined_lower and "dual" not in joined_lower) or ("psu" in joined_lower and "fail" in joined_lower and "dual" not in joined_lower)
+        psu_single_fail = not (kw & _KW_DUAL) and (
+            (kw & _KW_POWER_SUPPLY and kw & _KW_FAILED) or (kw & _KW_PSU and kw & _KW_FAIL)
+        )
         if psu_single_fail:
             if psu_count >= 2:
                 return {"status": HealthStatus.WARNING, "reason": f"Single PSU failure with redundancy (psu_count={psu_count}) (local safety rule).", "impact_type": "Hardware/Redundancy"}
             return {"status": HealthStatus.CRITICAL, "reason": f"Single PSU failure without redundancy (psu_count={psu_count}) (local safety rule).", "impact_type": "Hardware/Physical"}
 
         # 2) FAN（黄色 / 熱兆候で赤）
-        fan_fail = ("fan fail" in joined_lower) or ("fan" in joined_lower and "fail" in joined_lower)
-        overheat_hint = ("high temperature" in joined_lower) or ("overheat" in joined_lower) or ("thermal" in joined_lower)
+        fan_fail = kw & _KW_FAN and kw & _KW_FAIL
+        overheat_hint = kw & _KW_OVERHEAT_HINT
         if fan_fail:
             if overheat_hint:
                 return {"status": HealthStatus.CRITICAL, "reason": "Fan failure with overheat/thermal symptom detected (local safety rule).", "impact_type": "Hardware/Physical"}
             return {"status": HealthStatus.WARNING, "reason": "Fan failure detected. Service likely continues but risk of thermal escalation (local safety rule).", "impact_type": "Hardware/Degraded"}
 
         # 3) メモリ（黄色 / OOMで赤）
-        mem_symptom = ("memory high" in joined_lower) or ("memory leak" in joined_lower) or ("memory" in joined_lower and ("leak" in joined_lower or "high" in joined_lower))
-        oom_hint = ("out of memory" in joined_lower) or ("oom" in joined_lower) or ("killed process" in joined_lower) or ("kernel panic" in joined_lower)
+        mem_symptom = kw & _KW_MEMORY and kw & (_KW_LEAK | _KW_HIGH)
+        oom_hint = kw & _KW_OOM_HINT
         if mem_symptom:
             if oom_hint:
                 return {"status": HealthStatus.CRITICAL, "reason": "Memory leak/high with OOM/crash symptom detected (local safety rule).", "impact_type": "Software/Resource"}
             return {"status": HealthStatus.WARNING, "reason": "Memory high/leak symptom detected. Likely degraded but not down yet (local safety rule).", "impact_type": "Software/Resource"}
 
-        # 4) LLM
-        if not self._ensure_api_configured():
-            return {"status": HealthStatus.WARNING, "reason": "API key not configured. Manual analysis required.", "impact_type": "UNKNOWN"}
+        return None
 
-        metadata = self._get_metadata(device_id)
-        safe_config = self._sanitize_text(self._read_config(device_id))
+    # ==========================================================
+    # LLM (batched)
+    # ==========================================================
+    def _analyze_batch_with_llm(self, devices_alerts: Dict[str, List[str]]) -> Dict[str, Dict[str, Any]]:
+        """
+        複数デバイスを 1 回の LLM 呼び出しでまとめて判定し、device_id ごとの結果を返す。
+        同一 (device_id, アラート集合) の判定結果はキャッシュから返し、未判定のデバイスだけを LLM に送る。
+        """
+        contexts = {d: self._device_context(d) for d in devices_alerts}
+        digests = {d: _context_digest(*ctx) for d, ctx in contexts.items()}
+        keys = {d: _dev_cache_key(d, alerts, digests[d]) for d, alerts in devices_alerts.items()}
+        hits: Dict[str, Dict[str, Any]] = {}
+        with self._llm_result_lock:
+            for d, key in keys.items():
+                cached = self._llm_result_cache.get(key)
+                if cached is not None:
+                    self._llm_result_cache.move_to_end(key)
+                    hits[d] = dict(cached)
+        misses = {d: alerts for d, alerts in devices_alerts.items() if d not in hits}
+        if not misses:
+            return hits
+
+        results = self._query_llm_batch(misses, contexts)
+
+        # 正常に判定できた結果のみキャッシュ（API 未設定・AI エラーは次回再問い合わせ）
+        with self._llm_result_lock:
+            fresh = []
+            for d, analysis in results.items():
+                if analysis.get("impact_type") == "AI_ERROR" or "API key not configured" in analysis.get("reason", ""):
+                    continue
+                self._llm_result_cache[keys[d]] = dict(analysis)
+                self._llm_result_cache.move_to_end(keys[d])
+                fresh.append((keys[d], d, digests[d], analysis))
+            while len(self._llm_result_cache) > self.LLM_RESULT_CACHE_SIZE:
+                self._llm_result_cache.popitem(last=False)
+            self._append_checkpoint(fresh)
+
+        return {d: hits[d] if d in hits else results[d] for d in devices_alerts}
+
+    def _query_llm_batch(
+        self, devices_alerts: Dict[str, List[str]], contexts: Optional[Dict[str, tuple]] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """キャッシュを介さずに 1 回の LLM 呼び出しで判定する（contexts: device_id -> (metadata, サニタイズ済み Config)）"""
+        if not self._api_configured and not self._ensure_api_configured():
+            return {d: dict(NO_API_ANALYSIS) for d in devices_alerts}
+
+        items = []
+        for device_id, alerts in devices_alerts.items():
+            metadata, config = contexts[device_id] if contexts else self._device_context(device_id)
+            items.append({
+                "id": device_id,
+                "metadata": metadata,
+                "config": config,
+                "alerts": [self._sanitize_text(a) for a in alerts],
+            })
+        prompt = build_batched_prompt(items)
 
-        prompt = f"""
+        try:
+            response = self.model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+            parsed = _parse_batched_response(response.text)
+        except Exception as e:
+            print(f"[!] AI Inference Error: {e}")
+            return {
+                d: {"status": HealthStatus.WARNING, "reason": f"AI Analysis Failed: {str(e)}", "impact_type": "AI_ERROR"}
+                for d in devices_alerts
+            }
+
+        results: Dict[str, Dict[str, Any]] = {}
+        for device_id in devices_alerts:
+            item = parsed.get(device_id)
+            if item is None:
+                results[device_id] = {"status": HealthStatus.WARNING, "reason": "AI Analysis Failed: no result returned for device", "impact_type": "AI_ERROR"}
+                continue
+            results[device_id] = {
+                "status": _to_health_status(item.get("status", "CRITICAL")),
+                "reason": item.get("reason", "AI provided no reason"),
+                "impact_type": item.get("impact_type", "UNKNOWN"),
+            }
+        return results
+
+
+# ==========================================================
+# Batched prompt helpers
+# ==========================================================
+def _dumps_for_prompt(obj: Any) -> str:
+    """プロンプト埋め込み用の JSON（orjson があれば C 実装で直列化。非対応型は標準 json へ）"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
+
+# ★ プロンプトの固定部分はモジュール定数にし、呼び出しごとは可変部分の連結のみ行う
+_BATCH_PROMPT_PREFIX = """
 あなたはネットワーク運用のエキスパートAIです。
-以下の情報に基づき、現在発生しているアラートが「サービス停止(CRITICAL)」を引き起こしているか、
+以下の各デバイス（<item> ごと）について、現在発生しているアラートが「サービス停止(CRITICAL)」を引き起こしているか、
 それとも「冗長機能によりサービスは維持されている(WARNING)」状態かを判定してください。
 
 ### 対象デバイス
-- Device ID: {device_id}
-- Metadata: {json.dumps(metadata, ensure_ascii=False)}
-
-### 設定ファイル (Config - Sanitized)
-{safe_config}
+"""
 
-### 発生中のアラートリスト
-{json.dumps(safe_alerts, ensure_ascii=False)}
+_BATCH_PROMPT_SUFFIX = """
 
 ### 判定ルール（重要）
 - “冗長が効いている（サービス継続）”と判断できる限り、CRITICALにしないこと。
@@ -403,32 +864,61 @@ class LogicalRCA:
 
 ### 出力フォーマット
 以下のJSON形式のみを出力してください（Markdownコードブロックは不要）。
-{{
-  "status": "NORMAL|WARNING|CRITICAL",
-  "reason": "判定理由を簡潔に記述",
-  "impact_type": "NONE|DEGRADED|REDUNDANCY_LOST|OUTAGE|UNKNOWN"
-}}
+各 <item> の id ごとに 1 件ずつ、results 配列に含めてください。
+{
+  "results": [
+    {
+      "id": "<item の id>",
+      "status": "NORMAL|WARNING|CRITICAL",
+      "reason": "判定理由を簡潔に記述",
+      "impact_type": "NONE|DEGRADED|REDUNDANCY_LOST|OUTAGE|UNKNOWN"
+    }
+  ]
+}
 """
 
-        try:
-            response = self.model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
-            response_text = response.text.strip()
-            if response_text.startswith("```json"):
-                response_text = response_text[7:]
-            if response_text.endswith("```"):
-                response_text = response_text[:-3]
-            result_json = json.loads(response_text)
-
-            status_str = str(result_json.get("status", "CRITICAL")).upper()
-            if status_str in ["GREEN", "NORMAL"]:
-                health_status = HealthStatus.NORMAL
-            elif status_str in ["YELLOW", "WARNING"]:
-                health_status = HealthStatus.WARNING
-            else:
-                health_status = HealthStatus.CRITICAL
 
-            return {"status": health_status, "reason": result_json.get("reason", "AI provided no reason"), "impact_type": result_json.get("impact_type", "UNKNOWN")}
+def _batched_prompt_item(item: Dict[str, Any]) -> str:
+    """1 デバイス分の <item> ブロック"""
+    return "".join((
+        '<item id="', str(item["id"]), '">\n',
+        "- Device ID: ", str(item["id"]), "\n",
+        "- Metadata: ", _dumps_for_prompt(item.get("metadata", {})), "\n",
+        "\n#### 設定ファイル (Config - Sanitized)\n",
+        item.get("config", ""), "\n",
+        "\n#### 発生中のアラートリスト\n",
+        _dumps_for_prompt(item.get("alerts", [])), "\n",
+        "</item>",
+    ))
 
-        except Exception as e:
-            print(f"[!] AI Inference Error: {e}")
-            return {"status": HealthStatus.WARNING, "reason": f"AI Analysis Failed: {str(e)}", "impact_type": "AI_ERROR"}
+
+def build_batched_prompt(items: List[Dict[str, Any]]) -> str:
+    """
+    複数デバイスの判定依頼を 1 つのプロンプトにまとめる。
+    items: [{"id", "metadata", "config", "alerts"}, ...]
+    """
+    devices_block = "\n\n".join(map(_batched_prompt_item, items))
+    return "".join((_BATCH_PROMPT_PREFIX, devices_block, _BATCH_PROMPT_SUFFIX))
+
+
+def _parse_batched_response(response_text: str) -> Dict[str, Dict[str, Any]]:
+    """バッチ応答(JSON)を device_id -> 結果 の辞書に変換する。"""
+    text = response_text.strip()
+    # ★ 開始フェンスは ```json / ``` の両方を除去
+    if text.startswith("```"):
+        text = text[7:] if text.startswith("```json") else text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    # orjson があれば高速にパース（不正 JSON は json.loads と同様に ValueError 系で失敗する）
+    data = orjson.loads(text) if orjson is not None else json.loads(text)
+
+    entries = data.get("results", []) if isinstance(data, dict) else data
+    parsed: Dict[str, Dict[str, Any]] = {}
+    for entry in entries or []:
+        if isinstance(entry, dict) and entry.get("id"):
+            parsed[str(entry["id"])] = entry
+    return parsed
+
+
+def _to_health_status(status: Any) -> HealthStatus:
+    return _STATUS_STR_TO_HEALTH.get(str(status).upper(), HealthStatus.CRITICAL)
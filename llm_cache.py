@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+AIOps Agent - LLM Response Disk Cache Module
+=========================================================
+app.py / network_ops.py で共有する LLM 応答の SQLite キャッシュ
+- llm_cache: プロンプトハッシュ -> 応答テキスト（TTL 付き）
+- reports:   レポート/復旧プランのキー -> 本文
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+LLM_CACHE_PATH = ".llm_cache.sqlite3"
+LLM_CACHE_TTL = 24 * 3600  # 秒
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def prompt_key(model_name: str, prompt: str, temperature: Optional[float] = None) -> str:
+    """モデル名 + temperature + 正規化プロンプトのハッシュ"""
+    payload = f"{model_name}|{temperature}|{(prompt or '').strip()}"
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=20).hexdigest()
+
+
+def _get_conn() -> sqlite3.Connection:
+    """sqlite3 接続を遅延生成してプロセス内で共有（呼び出し側で _lock を保持）"""
+    global _conn
+    if _conn is None:
+        parent = os.path.dirname(LLM_CACHE_PATH)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, text TEXT NOT NULL, ts REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS reports (k TEXT PRIMARY KEY, v TEXT NOT NULL)")
+        conn.commit()
+        _conn = conn
+    return _conn
+
+
+def get_response(key: str) -> Optional[str]:
+    """LLM 応答の参照（期限切れ・読込失敗は None）"""
+    try:
+        with _lock:
+            row = _get_conn().execute("SELECT text, ts FROM llm_cache WHERE key = ?", (key,)).fetchone()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"LLM cache read error: {e}")
+        return None
+    if row and time.time() - row[1] < LLM_CACHE_TTL:
+        return row[0]
+    return None
+
+
+def set_response(key: str, text: str) -> None:
+    """LLM 応答の保存（失敗してもログのみ）"""
+    try:
+        with _lock:
+            conn = _get_conn()
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key, text, ts) VALUES (?, ?, ?)", (key, text, time.time()))
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"LLM cache write error: {e}")
+
+
+def get_report(key: str) -> Optional[str]:
+    """レポート/復旧プランの参照（読込失敗は None）"""
+    try:
+        with _lock:
+            row = _get_conn().execute("SELECT v FROM reports WHERE k = ?", (key,)).fetchone()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Report cache read error: {e}")
+        return None
+    return row[0] if row else None
+
+
+def set_report(key: str, text: str) -> None:
+    """レポート/復旧プランの保存（失敗してもログのみ）"""
+    try:
+        with _lock:
+            conn = _get_conn()
+            conn.execute("INSERT OR REPLACE INTO reports (k, v) VALUES (?, ?)", (key, text))
+            conn.commit()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"Report cache write error: {e}")
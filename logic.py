@@ -5,9 +5,10 @@ Google Antigravity AIOps Agent - Logic Module (Optimized Final)
 """
 
 import logging
+from collections import deque
 from typing import List, Dict, Set, Optional
 from dataclasses import dataclass, field
-from data import TOPOLOGY, NetworkNode
+from data import TOPOLOGY, NetworkNode, get_topology_index
 
 # =====================================================
 # ロギング設定
@@ -18,10 +19,11 @@ logger = logging.getLogger(__name__)
 # データクラス定義
 # =====================================================
 
-@dataclass
+@dataclass(slots=True)
 class Alarm:
     """
     ネットワークアラームを表現するデータクラス
+    （大量生成されるため __slots__ で __dict__ を持たない軽量レイアウトにする）
     """
     device_id: str
     message: str
@@ -41,10 +43,11 @@ class Alarm:
         if not self.device_id or not isinstance(self.device_id, str):
             raise ValueError(f"Invalid device_id: {self.device_id}")
 
-@dataclass
+@dataclass(slots=True)
 class InferenceResult:
     """
     因果推論の結果を表現するデータクラス
+    （Alarm と同じく __slots__ レイアウト）
     """
     root_cause_node: Optional[NetworkNode]
     root_cause_reason: str
@@ -228,6 +231,22 @@ class CausalInferenceEngine:
 # ユーティリティ関数
 # =====================================================
 
+def _cascade_device_ids(root_cause_id: str, topology: Dict[str, NetworkNode]) -> List[str]:
+    """根本原因配下のデバイスIDを BFS 順で返す（親 -> 子の索引を使い、各段でトポロジー全走査しない）"""
+    children = get_topology_index(topology).children
+    order = []
+    queue = deque([root_cause_id])
+    processed = {root_cause_id}
+    while queue:
+        current_parent_id = queue.popleft()
+        for child_id in children.get(current_parent_id, ()):
+            if child_id not in processed:
+                order.append(child_id)
+                queue.append(child_id)
+                processed.add(child_id)
+    return order
+
+
 def simulate_cascade_failure(
     root_cause_id: str, 
     topology: Dict[str, NetworkNode], 
@@ -237,30 +256,12 @@ def simulate_cascade_failure(
     if root_cause_id not in topology:
         raise ValueError(f"Device {root_cause_id} not found in topology")
     
-    generated_alarms = []
-    
-    # 根本原因のアラーム生成
-    root_alarm = Alarm(root_cause_id, custom_message, "CRITICAL")
-    generated_alarms.append(root_alarm)
-    
-    # BFSで子デバイスを探索
-    queue = [root_cause_id]
-    processed = {root_cause_id}
-    
-    while queue:
-        current_parent_id = queue.pop(0)
-        children = [
-            n for n in topology.values() 
-            if n.parent_id == current_parent_id
-        ]
-        
-        for child in children:
-            if child.id not in processed:
-                child_alarm = Alarm(child.id, "Unreachable", "WARNING")
-                generated_alarms.append(child_alarm)
-                queue.append(child.id)
-                processed.add(child.id)
-                
+    # 根本原因のアラーム + 配下デバイスの到達不能アラーム
+    generated_alarms = [Alarm(root_cause_id, custom_message, "CRITICAL")]
+    generated_alarms.extend(
+        Alarm(child_id, "Unreachable", "WARNING")
+        for child_id in _cascade_device_ids(root_cause_id, topology)
+    )
     return generated_alarms
 
 # =====================================================
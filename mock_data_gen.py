@@ -1,5 +1,6 @@
-import pandas as pd
-import random
+import csv
+
+import numpy as np
 
 # 生成するデータ数
 NUM_SAMPLES = 6000 
@@ -81,37 +82,65 @@ SCENARIOS = [
     }
 ]
 
+# L2_SW シナリオの根本原因候補（APも混ぜる）
+L2_SW_ROOT_IDS = ["L2_SW_01", "L2_SW_02", "AP_01", "AP_02"]
+UNKNOWN_ERROR_RATE = 0.05
+
 def generate_mock_data():
-    data = []
     print(f"Generating {NUM_SAMPLES} training samples based on World Model...")
-    
-    for _ in range(NUM_SAMPLES):
-        scenario = random.choices(SCENARIOS, weights=[s["weight"] for s in SCENARIOS])[0]
-        
-        r_id = scenario['root_cause_id']
-        if r_id == "L2_SW":
-            r_id = random.choice(["L2_SW_01", "L2_SW_02", "AP_01", "AP_02"]) # APも混ぜる
-            
-        root_key = f"{r_id}::{scenario['root_cause_type']}"
-        
-        for (ev_type, ev_val), prob in scenario["probabilities"].items():
-            if random.random() < prob:
-                data.append({
-                    "RootCause": root_key,
-                    "EvidenceType": ev_type,
-                    "EvidenceValue": ev_val
-                })
-        
-        if random.random() < 0.05:
-            data.append({
-                "RootCause": root_key,
-                "EvidenceType": "log",
-                "EvidenceValue": "Unknown Error"
-            })
+    rng = np.random.default_rng()
+
+    # ★ シナリオ選択・根本原因ID・証跡の発生判定を NumPy で一括サンプリング（サンプルごとの Python ループを排除）
+    weights = np.array([s["weight"] for s in SCENARIOS], dtype=float)
+    scenario_idx = rng.choice(len(SCENARIOS), size=NUM_SAMPLES, p=weights / weights.sum())
+
+    root_keys = np.empty(NUM_SAMPLES, dtype=object)
+    sample_parts, event_parts = [], []
+    ev_types, ev_vals = [], []
+    for i, scenario in enumerate(SCENARIOS):
+        samples = np.flatnonzero(scenario_idx == i)
+        r_type = scenario["root_cause_type"]
+        if scenario["root_cause_id"] == "L2_SW":
+            picked = rng.choice(L2_SW_ROOT_IDS, size=len(samples))
+            root_keys[samples] = [f"{r_id}::{r_type}" for r_id in picked]
+        else:
+            root_keys[samples] = f"{scenario['root_cause_id']}::{r_type}"
+
+        # 証跡は全シナリオ通しの番号で保持（同一サンプル内は定義順に並べるための並び順も兼ねる）
+        offset = len(ev_types)
+        probs = np.array(list(scenario["probabilities"].values()))
+        for ev_type, ev_val in scenario["probabilities"]:
+            ev_types.append(ev_type)
+            ev_vals.append(ev_val)
+        rows, cols = np.nonzero(rng.random((len(samples), len(probs))) < probs)
+        sample_parts.append(samples[rows])
+        event_parts.append(cols + offset)
+
+    # 未知のエラー（ノイズ）は各サンプルの最後に付与
+    unknown_id = len(ev_types)
+    ev_types.append("log")
+    ev_vals.append("Unknown Error")
+    unknown_samples = np.flatnonzero(rng.random(NUM_SAMPLES) < UNKNOWN_ERROR_RATE)
+    sample_parts.append(unknown_samples)
+    event_parts.append(np.full(len(unknown_samples), unknown_id))
+
+    sample_ids = np.concatenate(sample_parts)
+    event_ids = np.concatenate(event_parts)
+    order = np.lexsort((event_ids, sample_ids))  # サンプル順 -> 証跡の定義順
+    sample_ids = sample_ids[order]
+    event_ids = event_ids[order]
 
-    df = pd.DataFrame(data)
-    df.to_csv("training_data.csv", index=False)
-    print(f"✅ Saved 'training_data.csv' ({len(df)} records).")
+    # ★ DataFrame を経由せず、列配列から直接 CSV に書き出す（pandas.to_csv と同じ QUOTE_MINIMAL / LF 改行）
+    columns = (
+        root_keys[sample_ids],
+        np.array(ev_types, dtype=object)[event_ids],
+        np.array(ev_vals, dtype=object)[event_ids],
+    )
+    with open("training_data.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(("RootCause", "EvidenceType", "EvidenceValue"))
+        writer.writerows(zip(*columns))
+    print(f"✅ Saved 'training_data.csv' ({len(sample_ids)} records).")
 
 if __name__ == "__main__":
     generate_mock_data()
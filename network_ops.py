@@ -8,20 +8,25 @@ AIOps Agent - Network Operations Module (v3 - 根本修正版)
 3. 不要な待機処理の排除
 """
 
+from __future__ import annotations
+
 import re
 import os
 import time
 import json
 import hashlib
 import logging
+import threading
 import concurrent.futures
-from typing import Dict, List, Optional, Generator, Any
+from typing import TYPE_CHECKING, Dict, List, Optional, Generator, Any
 from enum import Enum
 
-import google.generativeai as genai
-from netmiko import ConnectHandler
+# ★ google.generativeai / netmiko は import コストが大きいため使用箇所で遅延インポートする
+if TYPE_CHECKING:
+    import google.generativeai as genai
 
 from rate_limiter import GlobalRateLimiter, RateLimitConfig
+import llm_cache
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +34,8 @@ logger = logging.getLogger(__name__)
 # 定数
 # =====================================================
 MODEL_NAME = "gemma-3-12b-it"
+# google-generativeai のトランスポート（gRPC = HTTP/2 多重化・常駐コネクション）
+GENAI_TRANSPORT = "grpc"
 
 SANDBOX_DEVICE = {
     'device_type': 'cisco_nxos',
@@ -41,6 +48,64 @@ SANDBOX_DEVICE = {
     'conn_timeout': 30,
 }
 
+# ★プロンプトの固定部分（役割・指示・出力フォーマット）はモジュール定数として先頭に置き、
+#   可変部分（対象情報）は末尾に連結する。先頭がバイト単位で毎回同一になるため
+#   サーバ側のプロンプトキャッシュが効きやすく、呼び出しごとの f-string 組み立ても減る。
+_ANALYST_PROMPT_PREFIX = """あなたはネットワーク障害の分析エキスパートです。
+以下の条件に従って、障害分析レポートを作成してください。
+
+【指示（この部分は出力に含めないでください）】
+- これは障害発生直後の分析です。復旧作業はまだ実施されていません
+- 「復旧しました」「再確立しました」のような完了形は使用しないでください
+- 文体は「です、ます」調で記載してください
+- 下記のフォーマットに従って本文のみを出力してください
+
+【出力フォーマット（この見出しは出力せず、以下の内容のみ出力）】
+## 障害概要
+## 発生原因（推定）
+## 影響範囲
+## 技術的根拠
+"""
+_ANALYST_STREAM_PROMPT_PREFIX = _ANALYST_PROMPT_PREFIX + "## 推奨対応\n"
+
+_REMEDIATION_PROMPT_HEAD = """あなたはネットワーク復旧のエキスパートです。
+以下の条件に従って、復旧手順を作成してください。
+
+【指示（この部分は出力に含めないでください）】
+- 文体は「です、ます」調で記載してください
+- 下記のフォーマットに従って本文のみを出力してください
+
+【出力フォーマット（この見出しは出力せず、以下の内容のみ出力）】
+"""
+_REMEDIATION_PROMPT_PREFIX = _REMEDIATION_PROMPT_HEAD + """## 前提作業
+## 復旧コマンド
+## 正常性確認
+"""
+_REMEDIATION_STREAM_PROMPT_PREFIX = _REMEDIATION_PROMPT_HEAD + """## 実施前提
+## バックアップ手順
+## 復旧コマンド
+## ロールバック手順
+## 正常性確認
+"""
+
+
+def _analyst_prompt_tail(scenario: str, device_id: str, vendor: str) -> str:
+    """原因分析プロンプトの可変部分（固定プレフィックスの後ろに連結する）"""
+    return f"""
+【対象情報】
+シナリオ: {scenario}
+デバイス: {device_id} ({vendor})
+"""
+
+
+def _remediation_prompt_tail(scenario: str, device_id: str, vendor: str) -> str:
+    """復旧手順プロンプトの可変部分（固定プレフィックスの後ろに連結する）"""
+    return f"""
+【対象情報】
+デバイス: {device_id} ({vendor})
+シナリオ: {scenario}
+"""
+
 
 class RemediationEnvironment(Enum):
     DEMO = "demo"
@@ -95,7 +160,9 @@ def _get_model(api_key: str) -> Optional[genai.GenerativeModel]:
     if not api_key:
         return None
     try:
-        genai.configure(api_key=api_key)
+        import google.generativeai as genai
+        # ★ gRPC（HTTP/2）の常駐チャネルを使い、TLS/接続を呼び出し間で再利用する
+        genai.configure(api_key=api_key, transport=GENAI_TRANSPORT)
         _model = genai.GenerativeModel(MODEL_NAME)
         _api_configured = True
         return _model
@@ -107,20 +174,40 @@ def _get_model(api_key: str) -> Optional[genai.GenerativeModel]:
 # =====================================================
 # ユーティリティ
 # =====================================================
+# 機密情報マスク（password/secret と SNMP community を 1 パスで置換）
+# ★ community 値自体が "<x>secret 5 <y>" の形なら、従来の 2 段置換と同じく両方を伏せる
+_SANITIZE_RE = re.compile(
+    r'(?P<pw>(?:password|secret) \d+ \S+)'
+    r'|(?P<snmp>snmp-server community) (?P<snmp_pw>\S*(?:password|secret) \d+ )?\S+'
+)
+
+
+def _sanitize_repl(m: re.Match) -> str:
+    if m.lastgroup == "pw":
+        return m.group("pw").split(" ", 1)[0] + " <HIDDEN>"
+    if m.group("snmp_pw") is not None:
+        return m.group("snmp") + " <HIDDEN> <HIDDEN>"
+    return m.group("snmp") + " <HIDDEN>"
+
+
 def sanitize_output(text: str) -> str:
     """機密情報をマスク"""
-    rules = [
-        (r'(password|secret) \d+ \S+', r'\1 <HIDDEN>'),
-        (r'(snmp-server community) \S+', r'\1 <HIDDEN>'),
-    ]
-    for pattern, replacement in rules:
-        text = re.sub(pattern, replacement, text)
-    return text
+    return _SANITIZE_RE.sub(_sanitize_repl, text)
 
 
 def compute_cache_hash(scenario: str, device_id: str, extra: str = "") -> str:
-    """キャッシュキー生成"""
-    return hashlib.md5(f"{scenario}|{device_id}|{extra}".encode()).hexdigest()
+    """キャッシュキー生成（blake2b: 短い文字列では md5/sha1 より高速。キャッシュはメモリ内のみのため既存ダイジェストとの互換は不要）"""
+    return hashlib.blake2b(f"{scenario}|{device_id}|{extra}".encode("utf-8"), digest_size=20).hexdigest()
+
+
+def _strip_code_fence(text: str) -> str:
+    """応答全体を囲む ``` / ```json フェンスを除去（strip は1回、判定は startswith/endswith のみ）"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text[7:] if text.startswith("```json") else text[3:]
+    if text.endswith("```"):
+        text = text[:-3]
+    return text
 
 
 def _extract_text(chunk) -> str:
@@ -234,6 +321,11 @@ def generate_fake_log_by_ai(scenario_name: str, target_node, api_key: str) -> st
 
     vendor = target_node.metadata.get("vendor", "Generic")
     prompt = f"CLIログ生成。ホスト:{target_node.id} ベンダー:{vendor} シナリオ:{scenario_name}。コマンド2個と出力のみ。"
+    disk_key = llm_cache.prompt_key(MODEL_NAME, prompt)
+    stored = llm_cache.get_response(disk_key)
+    if stored is not None:
+        limiter.set_cache(cache_key, stored)
+        return stored
 
     try:
         if not limiter.wait_for_slot(timeout=30):
@@ -243,6 +335,8 @@ def generate_fake_log_by_ai(scenario_name: str, target_node, api_key: str) -> st
         response = model.generate_content(prompt)
         result = response.text if response else "Error: No response"
         limiter.set_cache(cache_key, result)
+        if response and result:
+            llm_cache.set_response(disk_key, result)
         return result
     except Exception as e:
         return f"Error: {e}"
@@ -265,15 +359,21 @@ def predict_initial_symptoms(scenario_name: str, api_key: str) -> Dict:
         return cached
 
     prompt = f'シナリオ「{scenario_name}」の症状をJSON出力。キー:alarm,ping,log'
+    disk_key = llm_cache.prompt_key(MODEL_NAME, prompt)
 
     try:
-        if not limiter.wait_for_slot(timeout=30):
-            return {}
-        limiter.record_request()
-        
-        response = model.generate_content(prompt)
-        text = response.text.replace("```json", "").replace("```", "").strip()
-        result = json.loads(text)
+        text = llm_cache.get_response(disk_key)
+        if text is None:
+            if not limiter.wait_for_slot(timeout=30):
+                return {}
+            limiter.record_request()
+
+            response = model.generate_content(prompt)
+            text = response.text
+            result = json.loads(_strip_code_fence(text))
+            llm_cache.set_response(disk_key, text)  # JSON として読めた応答のみ永続化
+        else:
+            result = json.loads(_strip_code_fence(text))
         limiter.set_cache(cache_key, result)
         return result
     except Exception:
@@ -306,25 +406,12 @@ def generate_analyst_report(
     device_id = target_node.id if target_node else "Unknown"
     vendor = target_node.metadata.get("vendor", "Unknown") if target_node else "Unknown"
 
-    prompt = f"""あなたはネットワーク障害の分析エキスパートです。
-以下の条件に従って、障害分析レポートを作成してください。
-
-【指示（この部分は出力に含めないでください）】
-- これは障害発生直後の分析です。復旧作業はまだ実施されていません
-- 「復旧しました」「再確立しました」のような完了形は使用しないでください
-- 文体は「です、ます」調で記載してください
-- 下記のフォーマットに従って本文のみを出力してください
-
-【対象情報】
-シナリオ: {scenario}
-デバイス: {device_id} ({vendor})
-
-【出力フォーマット（この見出しは出力せず、以下の内容のみ出力）】
-## 障害概要
-## 発生原因（推定）
-## 影響範囲
-## 技術的根拠
-"""
+    prompt = _ANALYST_PROMPT_PREFIX + _analyst_prompt_tail(scenario, device_id, vendor)
+    disk_key = llm_cache.prompt_key(MODEL_NAME, prompt, 0.1)
+    stored = llm_cache.get_response(disk_key)
+    if stored is not None:
+        limiter.set_cache(cache_key, stored)
+        return stored
 
     try:
         if not limiter.wait_for_slot(timeout=30):
@@ -337,6 +424,8 @@ def generate_analyst_report(
         )
         result = response.text if response else "Error: No response"
         limiter.set_cache(cache_key, result)
+        if response and result:
+            llm_cache.set_response(disk_key, result)
         return result
     except Exception as e:
         return f"Error: {e}"
@@ -376,26 +465,13 @@ def generate_analyst_report_streaming(
 
     vendor = target_node.metadata.get("vendor", "Unknown") if target_node else "Unknown"
 
-    prompt = f"""あなたはネットワーク障害の分析エキスパートです。
-以下の条件に従って、障害分析レポートを作成してください。
-
-【指示（この部分は出力に含めないでください）】
-- これは障害発生直後の分析です。復旧作業はまだ実施されていません
-- 「復旧しました」「再確立しました」のような完了形は使用しないでください
-- 文体は「です、ます」調で記載してください
-- 下記のフォーマットに従って本文のみを出力してください
-
-【対象情報】
-シナリオ: {scenario}
-デバイス: {device_id} ({vendor})
-
-【出力フォーマット（この見出しは出力せず、以下の内容のみ出力）】
-## 障害概要
-## 発生原因（推定）
-## 影響範囲
-## 技術的根拠
-## 推奨対応
-"""
+    prompt = _ANALYST_STREAM_PROMPT_PREFIX + _analyst_prompt_tail(scenario, device_id, vendor)
+    disk_key = llm_cache.prompt_key(MODEL_NAME, prompt, 0.1)
+    stored = llm_cache.get_response(disk_key)
+    if stored is not None:
+        limiter.set_cache(cache_key, stored)
+        yield stored
+        return
 
     # ★ストリーミング生成（遅延なし）
     full_text = ""
@@ -406,6 +482,8 @@ def generate_analyst_report_streaming(
     # 完了後にキャッシュ保存
     if full_text and not full_text.startswith("❌"):
         limiter.set_cache(cache_key, full_text)
+        if "⏳" not in full_text and "❌ エラー" not in full_text:  # 再試行・途中失敗を含まない完走応答のみ永続化
+            llm_cache.set_response(disk_key, full_text)
 
 
 # =====================================================
@@ -432,22 +510,12 @@ def generate_remediation_commands(
 
     vendor = target_node.metadata.get("vendor", "Unknown") if target_node else "Unknown"
 
-    prompt = f"""あなたはネットワーク復旧のエキスパートです。
-以下の条件に従って、復旧手順を作成してください。
-
-【指示（この部分は出力に含めないでください）】
-- 文体は「です、ます」調で記載してください
-- 下記のフォーマットに従って本文のみを出力してください
-
-【対象情報】
-デバイス: {device_id} ({vendor})
-シナリオ: {scenario}
-
-【出力フォーマット（この見出しは出力せず、以下の内容のみ出力）】
-## 前提作業
-## 復旧コマンド
-## 正常性確認
-"""
+    prompt = _REMEDIATION_PROMPT_PREFIX + _remediation_prompt_tail(scenario, device_id, vendor)
+    disk_key = llm_cache.prompt_key(MODEL_NAME, prompt, 0.1)
+    stored = llm_cache.get_response(disk_key)
+    if stored is not None:
+        limiter.set_cache(cache_key, stored)
+        return stored
 
     try:
         if not limiter.wait_for_slot(timeout=30):
@@ -460,6 +528,8 @@ def generate_remediation_commands(
         )
         result = response.text if response else "Error: No response"
         limiter.set_cache(cache_key, result)
+        if response and result:
+            llm_cache.set_response(disk_key, result)
         return result
     except Exception as e:
         return f"Error: {e}"
@@ -502,24 +572,13 @@ def generate_remediation_commands_streaming(
 
     vendor = target_node.metadata.get("vendor", "Unknown") if target_node else "Unknown"
 
-    prompt = f"""あなたはネットワーク復旧のエキスパートです。
-以下の条件に従って、復旧手順を作成してください。
-
-【指示（この部分は出力に含めないでください）】
-- 文体は「です、ます」調で記載してください
-- 下記のフォーマットに従って本文のみを出力してください
-
-【対象情報】
-デバイス: {device_id} ({vendor})
-シナリオ: {scenario}
-
-【出力フォーマット（この見出しは出力せず、以下の内容のみ出力）】
-## 実施前提
-## バックアップ手順
-## 復旧コマンド
-## ロールバック手順
-## 正常性確認
-"""
+    prompt = _REMEDIATION_STREAM_PROMPT_PREFIX + _remediation_prompt_tail(scenario, device_id, vendor)
+    disk_key = llm_cache.prompt_key(MODEL_NAME, prompt, 0.1)
+    stored = llm_cache.get_response(disk_key)
+    if stored is not None:
+        limiter.set_cache(cache_key, stored)
+        yield stored
+        return
 
     # ★ストリーミング生成（遅延なし）
     full_text = ""
@@ -530,6 +589,79 @@ def generate_remediation_commands_streaming(
     # 完了後にキャッシュ保存
     if full_text and not full_text.startswith("❌"):
         limiter.set_cache(cache_key, full_text)
+        if "⏳" not in full_text and "❌ エラー" not in full_text:  # 再試行・途中失敗を含まない完走応答のみ永続化
+            llm_cache.set_response(disk_key, full_text)
+
+
+# =====================================================
+# SSH 接続プール（Live 診断で TCP/SSH ハンドシェイク・認証を呼び出し間で使い回す）
+# =====================================================
+SSH_IDLE_TIMEOUT = 300  # 秒。これを超えて使われていない接続は切断する
+
+
+def _ssh_pool_key(device: Dict[str, Any]) -> tuple:
+    return (device.get("host"), device.get("port"), device.get("username"), device.get("device_type"))
+
+
+class _ConnPool:
+    """デバイス単位の Netmiko 接続プール（スレッドセーフ。アイドル接続はバックグラウンドで回収）"""
+
+    def __init__(self, idle_timeout: float = SSH_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._idle: Dict[tuple, List[Any]] = {}
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+
+    def acquire(self, device: Dict[str, Any]):
+        key = _ssh_pool_key(device)
+        while True:
+            with self._lock:
+                conns = self._idle.get(key)
+                ssh = conns.pop() if conns else None
+            if ssh is None:
+                from netmiko import ConnectHandler  # 遅延インポート（Live 診断時のみ）
+                return ConnectHandler(**device)
+            try:
+                if ssh.is_alive():
+                    return ssh
+            except Exception:
+                pass
+            self._close(ssh)
+
+    def release(self, device: Dict[str, Any], ssh, healthy: bool = True) -> None:
+        if not healthy:
+            self._close(ssh)
+            return
+        ssh._last_used = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(_ssh_pool_key(device), []).append(ssh)
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_loop, name="ssh-pool-reaper", daemon=True)
+                self._reaper.start()
+
+    def _reap_loop(self) -> None:
+        while True:
+            time.sleep(self.idle_timeout / 5)
+            now = time.monotonic()
+            expired = []
+            with self._lock:
+                for key, conns in self._idle.items():
+                    keep = []
+                    for ssh in conns:
+                        (expired if now - ssh._last_used > self.idle_timeout else keep).append(ssh)
+                    conns[:] = keep
+            for ssh in expired:
+                self._close(ssh)
+
+    @staticmethod
+    def _close(ssh) -> None:
+        try:
+            ssh.disconnect()
+        except Exception:
+            pass
+
+
+_SSH_POOL = _ConnPool()
 
 
 # =====================================================
@@ -549,14 +681,22 @@ def run_diagnostic_simulation(
     if "[Live]" in scenario_type:
         commands = ["terminal length 0", "show version", "show interface brief"]
         try:
-            with ConnectHandler(**SANDBOX_DEVICE) as ssh:
-                if not ssh.check_enable_mode():
-                    ssh.enable()
-                raw_output = f"Connected to: {ssh.find_prompt()}\n"
-                for cmd in commands:
-                    raw_output += f"\n[{cmd}]\n{ssh.send_command(cmd)}\n"
+            ssh = _SSH_POOL.acquire(SANDBOX_DEVICE)
         except Exception as e:
             return {"status": "ERROR", "sanitized_log": "", "error": str(e)}
+        healthy = False
+        try:
+            if not ssh.check_enable_mode():
+                ssh.enable()
+            raw_output = f"Connected to: {ssh.find_prompt()}\n"
+            for cmd in commands:
+                raw_output += f"\n[{cmd}]\n{ssh.send_command(cmd)}\n"
+            healthy = True
+        except Exception as e:
+            return {"status": "ERROR", "sanitized_log": "", "error": str(e)}
+        finally:
+            # 失敗した接続はプールに戻さず切断する
+            _SSH_POOL.release(SANDBOX_DEVICE, ssh, healthy=healthy)
         return {"status": "SUCCESS", "sanitized_log": sanitize_output(raw_output), "error": None}
 
     elif "全回線断" in scenario_type or "サイレント" in scenario_type or "両系" in scenario_type:
@@ -572,6 +712,11 @@ def run_diagnostic_simulation(
 # =====================================================
 # 並列修復処理
 # =====================================================
+# ★ 実機（SSH）修復用のスレッドプールはプロセスで1つを使い回す（呼び出しごとのスレッド生成・join を省く）
+#   DEMO はこのプールを使わない（他セッションの実機ステップが詰まっても DEMO が待たされないように）
+_REMEDIATION_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="remediation")
+
+
 def run_remediation_parallel_v2(
     device_id: str,
     device_info: dict,
@@ -579,7 +724,7 @@ def run_remediation_parallel_v2(
     environment: RemediationEnvironment = RemediationEnvironment.DEMO,
     timeout_per_step: int = 30
 ) -> Dict[str, RemediationResult]:
-    """修復ステップを並列実行"""
+    """修復ステップを実行（DEMO は逐次、実機はプールで並列・呼び出し全体を timeout_per_step × ステップ数で打ち切り）"""
 
     def backup_step():
         time.sleep(1)
@@ -593,19 +738,28 @@ def run_remediation_parallel_v2(
         time.sleep(1)
         return RemediationResult("Verify", "success", {"overall": "HEALTHY"})
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-        futures = {
-            executor.submit(backup_step): "Backup",
-            executor.submit(apply_step): "Apply",
-            executor.submit(verify_step): "Verify",
-        }
+    steps = [("Backup", backup_step), ("Apply", apply_step), ("Verify", verify_step)]
+    results = {}
 
-        results = {}
-        for future in concurrent.futures.as_completed(futures):
-            name = futures[future]
+    # ★ DEMO は処理が軽いので Future / スレッドを介さず逐次実行
+    if environment == RemediationEnvironment.DEMO:
+        for name, fn in steps:
             try:
-                results[name] = future.result(timeout=timeout_per_step)
+                results[name] = fn()
             except Exception as e:
                 results[name] = RemediationResult(name, "failed", error=str(e))
+        return results
+
+    futures = {_REMEDIATION_POOL.submit(fn): name for name, fn in steps}
+    _, not_done = concurrent.futures.wait(futures, timeout=timeout_per_step * len(steps))
+    for future, name in futures.items():
+        if future in not_done:
+            future.cancel()  # 未着手なら取り消し（実行中のスレッドは止められないが結果は待たない）
+            results[name] = RemediationResult(name, "timeout")
+            continue
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            results[name] = RemediationResult(name, "failed", error=str(e))
 
     return results